@@ -0,0 +1,90 @@
+"""Shared setup of the benchmark scripts.
+
+TGPy is run without a Telegram client, with its data directory in a temporary
+directory, so that the benchmarks don't touch the real config.
+"""
+
+import asyncio
+import contextvars
+import inspect
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable
+
+ROOT = Path(__file__).resolve().parent.parent
+CORPUS_DIR = Path(__file__).resolve().parent / 'corpus'
+
+os.environ.setdefault('TGPY_DATA', tempfile.mkdtemp(prefix='tgpy-bench-'))
+sys.path.insert(0, str(ROOT))
+
+# tgpy.api has to be imported before the modules of tgpy._core
+import tgpy.api  # noqa: E402, F401
+
+# standard modules which change how the code is parsed and evaluated
+STD_MODULES = ('constants', 'postfix_await', 'star_imports', 'client_fixes')
+
+
+async def setup():
+    """Load the standard modules which don't need a Telegram client"""
+    from tgpy import app
+    from tgpy.modules import get_std_modules
+
+    app.client = None
+    for module in get_std_modules():
+        if module.name in STD_MODULES:
+            await asyncio.create_task(module.run(), context=contextvars.copy_context())
+
+
+class FakeMessage:
+    """Message which is edited without Telegram"""
+
+    def __init__(self, message_id: int = 1):
+        self.chat = SimpleNamespace(id=1)
+        self.id = message_id
+        self.text = ''
+        self.entities = None
+        self.reply_to_message = None
+        self.edits = 0
+
+    async def edit_text(self, text, entities=None, **kwargs):
+        self.text = text
+        self.entities = entities
+        self.edits += 1
+        return self
+
+
+def skip_reaction_hashes():
+    """Don't save hashes of edited messages to the config on every edit"""
+    from tgpy import reactions_fix
+
+    reactions_fix.update_hash = lambda *args, **kwargs: None
+
+
+async def evaluate(code: str, **kwargs):
+    """tgpy_eval in a context of its own, like a message handler"""
+    from tgpy.api import tgpy_eval
+
+    return await asyncio.create_task(
+        tgpy_eval(code, **kwargs), context=contextvars.copy_context()
+    )
+
+
+async def best_of(repeat: int, func: Callable[[], Awaitable[Any] | Any]) -> float:
+    """The shortest of `repeat` runs of `func`, in seconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        if inspect.isawaitable(res := func()):
+            await res
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def read_chat_corpus() -> list[str]:
+    """Chat messages, separated by `---` lines"""
+    text = (CORPUS_DIR / 'chat.txt').read_text(encoding='utf-8')
+    return [x for x in text.split('\n---\n') if x.strip()]
@@ -0,0 +1,72 @@
+"""Measure how the time of an evaluation grows with the number of saved
+variables in the `args` and `namespace` evaluation modes.
+
+Before that, check that saved variables with the names the evaluation uses
+internally, like `tmp` and `__name__`, survive evaluations in both modes. Exits
+with status 1 otherwise.
+
+    python benchmarks/eval_mode.py [--variables 0 1000 5000] [--evals 20]
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+
+from _harness import evaluate, setup
+
+CODE = 'a = 1\na + len(ctx.__class__.__name__)'
+# saved variables which the evaluation must not touch
+RESERVED_NAMES = ('tmp', '__name__')
+
+
+async def check_reserved_names() -> bool:
+    ok = True
+    for name in RESERVED_NAMES:
+        await evaluate(f'{name} = 5')
+        result = (await evaluate(name)).result
+        await evaluate(f'{name} = 1\n{name} + 1')
+        again = (await evaluate(name)).result
+        if (result, again) != (5, 1):
+            ok = False
+            print(f'saved {name!r} is {result!r} and then {again!r}, not 5 and 1')
+    return ok
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variables', type=int, nargs='+', default=[0, 1000, 5000])
+    parser.add_argument('--evals', type=int, default=20)
+    args = parser.parse_args()
+
+    await setup()
+    import tgpy.api
+    from tgpy.api.tgpy_eval import EVAL_MODE_KEY
+
+    ok = True
+    for mode in ('args', 'namespace'):
+        tgpy.api.config.set(EVAL_MODE_KEY, mode)
+        ok = await check_reserved_names() and ok
+        for name in RESERVED_NAMES:
+            del tgpy.api.variables[name]
+
+        timings = []
+        for count in args.variables:
+            for name in [x for x in tgpy.api.variables if x.startswith('bench_')]:
+                del tgpy.api.variables[name]
+            for i in range(count):
+                tgpy.api.variables[f'bench_{i}'] = i
+            # the first evaluation fills the compile cache
+            await evaluate(CODE, filename='tgpy://eval/bench')
+            start = time.perf_counter()
+            for _ in range(args.evals):
+                await evaluate(CODE, filename='tgpy://eval/bench')
+            elapsed = (time.perf_counter() - start) / args.evals
+            timings.append(f'{count} variables {elapsed * 1e3:.2f} ms')
+        print(f'{mode}: ' + ', '.join(timings) + ' per evaluation')
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
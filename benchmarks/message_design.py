@@ -0,0 +1,120 @@
+"""Check that rendered TGPy messages fit the message length limit, and measure
+how long rendering takes with long results and output.
+
+Random renders with long parts, non-BMP characters and custom result entities
+must fit MESSAGE_LIMIT UTF-16 units, keep their entities inside the text and
+never split a surrogate pair. Exits with status 1 otherwise.
+
+    python benchmarks/message_design.py [--renders 300]
+"""
+
+import argparse
+import asyncio
+import random
+import sys
+
+from _harness import FakeMessage, best_of, skip_reaction_hashes
+
+CHARS = 'abc xyz\n\t  0123456789ąß€ЖЯ😀🙏𝔘'
+
+
+def random_text(rnd: random.Random, max_length: int) -> str:
+    return ''.join(rnd.choice(CHARS) for _ in range(rnd.randint(0, max_length)))
+
+
+def check_renders(count: int) -> bool:
+    from pyrogram.enums import MessageEntityType
+    from pyrogram.types import MessageEntity
+
+    from tgpy._core.message_design import MESSAGE_LIMIT, build_message, utf16_len
+
+    rnd = random.Random(0)
+    ok = True
+    for i in range(count):
+        result = random_text(rnd, 6000)
+        entities = [
+            MessageEntity(type=MessageEntityType.BOLD, offset=offset, length=5)
+            for offset in range(0, utf16_len(result.strip()), 50)
+        ]
+        text, entities = build_message(
+            random_text(rnd, rnd.choice((50, 3000, 5000))),
+            result,
+            random_text(rnd, 3000),
+            random_text(rnd, 8000),
+            is_running=bool(i % 2),
+            result_entities=entities if i % 3 == 0 else None,
+        )
+        length = utf16_len(text)
+        errors = []
+        if length > MESSAGE_LIMIT:
+            errors.append(f'{length} UTF-16 units')
+        if any('\ud800' <= c <= '\udfff' for c in text):
+            errors.append('a split surrogate pair')
+        if any(e.offset < 0 or e.offset + e.length > length for e in entities):
+            errors.append('an entity outside the text')
+        if any(e.length <= 0 for e in entities):
+            errors.append('an empty entity')
+        if errors:
+            ok = False
+            print(f'render {i} has ' + ', '.join(errors))
+    print(f'{count} random renders checked')
+    return ok
+
+
+async def measure():
+    from pyrogram.enums import MessageEntityType
+    from pyrogram.types import MessageEntity
+
+    from tgpy._core import message_design
+
+    skip_reaction_hashes()
+    message = FakeMessage()
+    output = 'line of the output\n' * 10_000
+
+    async def render_long_output():
+        message_design.forget_render(message)
+        await message_design.render_message(message, 'print(...)', output=output)
+
+    seconds = await best_of(20, render_long_output)
+    print(
+        f'render_message, {len(output) // 1000} KB output: {seconds * 1e3:.2f} ms, '
+        f'{message.edits} edits'
+    )
+
+    result = 'r' * 100_000
+    traceback = 't\n' * 7_500
+    seconds = await best_of(
+        200, lambda: message_design.build_message('code', result, traceback, output)
+    )
+    print(
+        'build_message, 100 KB result, 15 KB traceback, 190 KB output: '
+        f'{seconds * 1e6:.0f} µs'
+    )
+
+    def build_with_entities():
+        # build_message moves the entities, so they are created every time
+        entities = [
+            MessageEntity(type=MessageEntityType.BOLD, offset=i * 4, length=2)
+            for i in range(1000)
+        ]
+        message_design.build_message('code', result, result_entities=entities)
+
+    seconds = await best_of(50, build_with_entities)
+    print(
+        'build_message, 1000 result entities, including creating them: '
+        f'{seconds * 1e3:.2f} ms'
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--renders', type=int, default=300)
+    args = parser.parse_args()
+
+    ok = check_renders(args.renders)
+    await measure()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,93 @@
+"""Measure how fast evaluated code can print, with and without flushes, and
+with a message whose output is shown while the code runs.
+
+Each loop is compared with plain Python printing into a StringIO. Output of
+evaluated code goes through two Python-level `write` methods, the stdout
+wrapper and OutputBuffer, and `print` calls `write` twice. That is why
+print-heavy code is 2 to 3 times slower than with a StringIO, which is
+written in C. A write which doesn't fill a batch or reach a limit costs one
+comparison in OutputBuffer.
+
+The flushing loop with a message is also compared with the way output was
+captured before OutputBuffer: a StringIO, with `cleanup_erases` applied to the
+whole output on every flush. That grows quadratically with the output, so it
+runs for fewer iterations.
+
+    python benchmarks/output.py [--iterations 100000] [--legacy-iterations 5000]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+
+from _harness import FakeMessage, best_of, evaluate, setup, skip_reaction_hashes
+
+LOOPS = {
+    'print(i)': 'for i in range({n}):\n    print(i)',
+    'print(i, flush=True)': 'for i in range({n}):\n    print(i, flush=True)',
+    "sys.stdout.write('x')": (
+        'import sys\nfor i in range({n}):\n    sys.stdout.write("x")'
+    ),
+}
+
+
+class LegacyOutput(io.StringIO):
+    """StringIO which reads the output on every flush, like the flush handler
+    did for a message before OutputBuffer"""
+
+    def flush(self):
+        from tgpy.context import cleanup_erases
+
+        cleanup_erases(self.getvalue())
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=100_000)
+    parser.add_argument('--legacy-iterations', type=int, default=5_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    await setup()
+    skip_reaction_hashes()
+
+    for name, loop in LOOPS.items():
+        code = loop.format(n=args.iterations)
+        seconds = await best_of(args.repeat, lambda: evaluate(code))
+
+        def plain():
+            with contextlib.redirect_stdout(io.StringIO()):
+                exec(code, {})
+
+        baseline = await best_of(args.repeat, plain)
+        print(
+            f'{name}: {seconds * 1e3:.0f} ms '
+            f'(plain Python into StringIO: {baseline * 1e3:.0f} ms)'
+        )
+
+    message = FakeMessage()
+    code = LOOPS['print(i, flush=True)'].format(n=args.iterations)
+    seconds = await best_of(args.repeat, lambda: evaluate(code, message=message))
+    print(
+        f'print(i, flush=True) with a message: {seconds * 1e3:.0f} ms, '
+        f'{message.edits} edits'
+    )
+
+    code = LOOPS['print(i, flush=True)'].format(n=args.legacy_iterations)
+    seconds = await best_of(args.repeat, lambda: evaluate(code, message=message))
+
+    def legacy():
+        with contextlib.redirect_stdout(LegacyOutput()):
+            exec(code, {})
+
+    baseline = await best_of(args.repeat, legacy)
+    print(
+        f'print(i, flush=True) with a message, {args.legacy_iterations} iterations: '
+        f'{seconds * 1e3:.0f} ms (StringIO and cleanup_erases on every flush: '
+        f'{baseline * 1e3:.0f} ms)'
+    )
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,136 @@
+"""Check that the lexical pre-filter of parse_code never changes a decision, and
+measure how much faster plain-text messages are rejected with it.
+
+The corpus is the bundled chat sample, the paragraphs, lines and code blocks of
+the docs, the TGPy sources and their lines, and random strings made of tokens
+that are likely to confuse the pre-filter. Exits with status 1 if a text
+rejected by the pre-filter parses, or if parse_code decides differently
+without it.
+
+    python benchmarks/prefilter.py [--fuzz 300000] [--compare 20000]
+"""
+
+import argparse
+import ast
+import asyncio
+import random
+import re
+import sys
+import warnings
+
+from _harness import ROOT, best_of, read_chat_corpus, setup
+
+FUZZ_ATOMS = [
+    'x', 'y', 'foo', 'Привет', 'мир', 'if', 'else', 'not', 'in', 'is', 'match',
+    'case', 'type', 'lambda', 'await', 'print', '(', ')', '[', ']', ':', '=',
+    '==', '!=', '!', '?', '$', '`', '.', ',', '1', '2.5', '1e5', '0x1f', '"',
+    "'", '#', '\n', '\t', ' ', '  ', '—', '😀', '\xa0', 'é', 'ﬁ', '\\',
+    '\n    ', '*', 'import', 'from', 'as', 'def', 'return', 'f"', 'rb', '{',
+    '}', '@', '->', ';', '_', 'and', 'or',
+]  # fmt: skip
+
+
+def build_corpus() -> list[str]:
+    texts = read_chat_corpus()
+    for path in [*ROOT.glob('guide/docs/**/*.md'), *ROOT.glob('*.md')]:
+        text = path.read_text(encoding='utf-8')
+        texts += re.findall(r'```[a-z]*\n(.*?)```', text, re.S)
+        prose = re.sub(r'```.*?```', '', text, flags=re.S)
+        for paragraph in re.split(r'\n\s*\n', prose):
+            texts.append(paragraph.strip())
+            texts += [line.strip() for line in paragraph.splitlines()]
+    for path in ROOT.glob('tgpy/**/*.py'):
+        source = path.read_text(encoding='utf-8')
+        texts.append(source)
+        texts += source.splitlines()
+    return [x for x in texts if x]
+
+
+def fuzz(count: int, seed: int = 0) -> list[str]:
+    rnd = random.Random(seed)
+    return [
+        ''.join(
+            rnd.choice(FUZZ_ATOMS) + rnd.choice(('', ' ', ''))
+            for _ in range(rnd.randint(1, 12))
+        )
+        for _ in range(count)
+    ]
+
+
+def parses(text: str) -> bool:
+    try:
+        ast.parse(text)
+    except (SyntaxError, ValueError):
+        return False
+    return True
+
+
+async def decisions(texts: list[str]) -> list[tuple[bool, bool]]:
+    from tgpy.api.parse_code import parse_cache, parse_code
+
+    res = []
+    for text in texts:
+        parse_cache.clear()
+        parsed = await parse_code(text)
+        res.append((parsed.is_code, parsed.uses_orig))
+    return res
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fuzz', type=int, default=300_000)
+    parser.add_argument('--compare', type=int, default=20_000)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    await setup()
+    parse_code_module = sys.modules['tgpy.api.parse_code']
+    from tgpy._core.prefilter import definitely_not_code
+
+    corpus = build_corpus()
+    fuzzed = fuzz(args.fuzz)
+    failed = False
+
+    rejected = 0
+    for text in corpus + fuzzed:
+        if definitely_not_code(text):
+            rejected += 1
+            if parses(text):
+                failed = True
+                print(f'rejected, but parses: {text!r}')
+    print(
+        f'{len(corpus)} corpus and {len(fuzzed)} random texts, '
+        f'{rejected} rejected by the pre-filter'
+    )
+
+    texts = corpus + fuzzed[: args.compare]
+    with_prefilter = await decisions(texts)
+    parse_code_module.definitely_not_code = lambda text: False
+    without_prefilter = await decisions(texts)
+    differ = [
+        text for text, a, b in zip(texts, with_prefilter, without_prefilter) if a != b
+    ]
+    for text in differ[:10]:
+        failed = True
+        print(f'parse_code decides differently: {text!r}')
+    print(f'{len(texts)} texts through parse_code, {len(differ)} decisions differ')
+
+    chat = read_chat_corpus()
+    for kind, messages in (
+        ('chat messages', chat),
+        ('plain-text chat messages', [x for x in chat if not parses(x)]),
+    ):
+        for name, prefilter in (
+            ('without the pre-filter', lambda text: False),
+            ('with the pre-filter', definitely_not_code),
+        ):
+            parse_code_module.definitely_not_code = prefilter
+            seconds = await best_of(args.repeat, lambda: decisions(messages))
+            print(f'{kind} {name}: {len(messages) / seconds:.0f}/s')
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,351 @@
+import asyncio
+import importlib
+import io
+import multiprocessing
+import pickle
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import TextIOBase
+from types import ModuleType
+from typing import Any, Callable, Mapping
+
+import tgpy.api
+from tgpy._core import checkpoints
+from tgpy._core.meval import _meval
+from tgpy._core.pragmas import parse_pragmas
+from tgpy._core.utils import REMOTE_TRACEBACK_ATTR
+from tgpy.api.parse_code import ParseResult
+from tgpy.utils import FILENAME_PREFIX
+
+BACKEND_KEY = 'core.eval.backend'
+PROCESS_POOL_SIZE_KEY = 'core.eval.process_pool_size'
+DEFAULT_PROCESS_POOL_SIZE = 2
+THREAD_POOL_SIZE_KEY = 'core.eval.thread_pool_size'
+DEFAULT_THREAD_POOL_SIZE = 4
+
+LOOP = 'loop'
+PROCESS = 'process'
+THREAD = 'thread'
+BACKENDS = (LOOP, PROCESS, THREAD)
+
+# how often a worker sends the output of a running snippet, in seconds
+OUTPUT_INTERVAL = 0.5
+OUTPUT_CHUNK_SIZE = 8192
+
+_pool: ProcessPoolExecutor | None = None
+_manager = None
+_thread_pool: 'EvalThreadPool | None' = None
+
+
+def get_backend(code: str) -> str:
+    """Backend selected by the `# tgpy: backend=...` pragma or the config"""
+    backend = (
+        parse_pragmas(code).get('backend') or tgpy.api.config.get(BACKEND_KEY) or LOOP
+    )
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown eval backend: {backend!r}')
+    return backend
+
+
+class RemoteRepr:
+    """Stands for a result of the process backend which can't be pickled"""
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def __repr__(self):
+        return self.text
+
+    __str__ = __repr__
+
+
+class _QueueWriter(TextIOBase):
+    """Sends written text to the parent process in batches"""
+
+    def __init__(self, queue, stream: str):
+        self._queue = queue
+        self._stream = stream
+        self._buffer: list[str] = []
+        self._size = 0
+        self._last_sent = time.monotonic()
+
+    def write(self, s: str) -> int:
+        self._buffer.append(s)
+        self._size += len(s)
+        if (
+            self._size >= OUTPUT_CHUNK_SIZE
+            or time.monotonic() - self._last_sent >= OUTPUT_INTERVAL
+        ):
+            self.flush()
+        return len(s)
+
+    def flush(self) -> None:
+        if self._buffer:
+            self._queue.put((self._stream, ''.join(self._buffer)))
+            self._buffer.clear()
+            self._size = 0
+        self._last_sent = time.monotonic()
+
+
+class _Pickler(pickle.Pickler):
+    # imported modules are saved as variables, send them by name
+    def reducer_override(self, obj):
+        if isinstance(obj, ModuleType):
+            return importlib.import_module, (obj.__name__,)
+        return NotImplemented
+
+
+def _dumps(obj: Any) -> bytes:
+    file = io.BytesIO()
+    _Pickler(file, pickle.HIGHEST_PROTOCOL).dump(obj)
+    return file.getvalue()
+
+
+def _dump_values(
+    values: Mapping[str, Any], names: set[str] | None = None
+) -> tuple[dict[str, bytes], list[str]]:
+    """Pickle values one by one, skipping the ones that can't be pickled"""
+    dumped = {}
+    failed = []
+    if names is not None:
+        values = {name: values[name] for name in names if name in values}
+    for name, value in values.items():
+        try:
+            dumped[name] = _dumps(value)
+        except Exception:
+            failed.append(name)
+    return dumped, failed
+
+
+def _load_values(values: dict[str, bytes]) -> dict[str, Any]:
+    loaded = {}
+    for name, data in values.items():
+        try:
+            loaded[name] = pickle.loads(data)
+        except Exception:
+            # e.g. functions defined in messages can't be imported in the worker
+            pass
+    return loaded
+
+
+def _dump_exception(e: BaseException) -> bytes:
+    try:
+        data = _dumps(e)
+        pickle.loads(data)
+        return data
+    except Exception:
+        message = ''.join(traceback.format_exception_only(e)).strip()
+        return pickle.dumps(RuntimeError(message))
+
+
+def _format_user_traceback(e: BaseException) -> str:
+    # skip the frames of the worker itself
+    tb = e.__traceback__
+    while tb and not tb.tb_frame.f_code.co_filename.startswith(FILENAME_PREFIX):
+        tb = tb.tb_next
+    te = traceback.TracebackException(type(e), e, tb or e.__traceback__, compact=True)
+    return ''.join(te.format())
+
+
+def _run_in_worker(
+    parsed: ParseResult,
+    filename: str,
+    variables: dict[str, bytes],
+    constants: dict[str, bytes],
+    kwargs: dict[str, bytes],
+    output_queue,
+) -> tuple:
+    # loop checkpoints added by the parent's transformers refer to a builtin
+    checkpoints.install()
+    saved_variables = _load_values(variables)
+    namespace = _load_values(constants)
+    namespace.update(saved_variables)
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = _QueueWriter(output_queue, 'stdout')
+    sys.stderr = _QueueWriter(output_queue, 'stderr')
+    try:
+        try:
+            new_variables, result = asyncio.run(
+                _meval(
+                    parsed,
+                    filename,
+                    saved_variables,
+                    namespace=namespace,
+                    **_load_values(kwargs),
+                )
+            )
+        except BaseException as e:
+            return False, _dump_exception(e), _format_user_traceback(e)
+
+        # the result is sent separately
+        new_variables.pop('_', None)
+        new_variables, failed = _dump_values(new_variables)
+        if failed:
+            print(
+                f"Can't send back variables: {', '.join(failed)}",
+                file=sys.stderr,
+            )
+        try:
+            result = _dumps(result)
+        except Exception:
+            result = _dumps(RemoteRepr(repr(result)))
+        return True, new_variables, result
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sys.stdout, sys.stderr = stdout, stderr
+        output_queue.put(None)
+
+
+def _get_manager():
+    global _manager
+    if _manager is None:
+        _manager = multiprocessing.get_context('spawn').Manager()
+    return _manager
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            tgpy.api.config.get(PROCESS_POOL_SIZE_KEY) or DEFAULT_PROCESS_POOL_SIZE,
+            # forking a process with a running event loop and client is unsafe
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+    return _pool
+
+
+async def _forward_output(queue):
+    loop = asyncio.get_running_loop()
+    while (item := await loop.run_in_executor(None, queue.get)) is not None:
+        stream, data = item
+        stream = sys.stdout if stream == 'stdout' else sys.stderr
+        stream.write(data)
+        stream.flush()
+
+
+class EvalThreadPool(ThreadPoolExecutor):
+    """Thread pool which counts queued, running and completed snippets"""
+
+    def __init__(self, max_workers: int):
+        # The threads have no event loop set. With the running loop set, the sync
+        # wrappers of Pyrogram methods return coroutines, and a call without
+        # `await` silently does nothing. Such calls aren't supported here: code
+        # that awaits them runs in the event loop
+        super().__init__(max_workers, thread_name_prefix='tgpy-eval')
+        self._metrics_lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.max_queued = 0
+
+    def submit(self, fn: Callable, /, *args, **kwargs) -> Future:
+        with self._metrics_lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        return super().submit(self._measured, fn, *args, **kwargs)
+
+    def _measured(self, fn: Callable, *args, **kwargs):
+        with self._metrics_lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._metrics_lock:
+                self.running -= 1
+                self.completed += 1
+
+    @property
+    def metrics(self) -> dict[str, int]:
+        return {
+            'size': self._max_workers,
+            'queued': self.queued,
+            'running': self.running,
+            'completed': self.completed,
+            'max_queued': self.max_queued,
+        }
+
+
+def get_thread_pool() -> EvalThreadPool:
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = EvalThreadPool(
+            tgpy.api.config.get(THREAD_POOL_SIZE_KEY) or DEFAULT_THREAD_POOL_SIZE
+        )
+    return _thread_pool
+
+
+async def run_in_process(
+    parsed: ParseResult, filename: str, kwargs: dict[str, Any]
+) -> tuple[dict[str, Any], Any]:
+    """Evaluate parsed code in a worker of the process pool.
+
+    Only picklable values are exchanged with the worker: variables and constants
+    used by the code, new variables and the result. Output is forwarded to the
+    current stdout and stderr while the code runs.
+    """
+    global _pool
+    loop = asyncio.get_running_loop()
+    names = parsed.facts.names if parsed.facts else None
+    variables, _ = _dump_values(tgpy.api.variables, names)
+    constants, _ = _dump_values(tgpy.api.constants, names)
+    kwargs, _ = _dump_values(kwargs)
+    worker_parsed = ParseResult(
+        is_code=True,
+        uses_orig=parsed.uses_orig,
+        original=parsed.original,
+        transformed=parsed.transformed,
+        tree=parsed.tree,
+        facts=parsed.facts,
+    )
+
+    queue = await loop.run_in_executor(None, lambda: _get_manager().Queue())
+    forward_task = asyncio.create_task(_forward_output(queue))
+    try:
+        ok, *payload = await loop.run_in_executor(
+            _get_pool(),
+            _run_in_worker,
+            worker_parsed,
+            filename,
+            variables,
+            constants,
+            kwargs,
+            queue,
+        )
+    except BrokenProcessPool:
+        # a worker died, the next snippet will start a new pool
+        _pool = None
+        raise
+    finally:
+        # stop forwarding if the worker didn't do it
+        queue.put(None)
+        await forward_task
+
+    if not ok:
+        exc_data, tb = payload
+        exc = pickle.loads(exc_data)
+        setattr(exc, REMOTE_TRACEBACK_ATTR, tb)
+        raise exc
+    new_variables, result = payload
+    new_variables = _load_values(new_variables)
+    result = pickle.loads(result)
+    new_variables['_'] = result
+    return new_variables, result
+
+
+__all__ = [
+    'BACKEND_KEY',
+    'LOOP',
+    'PROCESS',
+    'THREAD',
+    'EvalThreadPool',
+    'get_backend',
+    'get_thread_pool',
+    'RemoteRepr',
+    'run_in_process',
+]
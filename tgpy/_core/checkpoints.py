@@ -0,0 +1,65 @@
+import asyncio
+import builtins
+import threading
+import time
+
+import tgpy.api
+
+# name of the checkpoint in builtins, so that it's available in any namespace
+CHECKPOINT_NAME = '__tgpy_checkpoint__'
+INTERVAL_KEY = 'core.checkpoints.interval'
+# how long the code may run without giving control to the event loop, in milliseconds
+DEFAULT_INTERVAL = 50
+
+_NO_YIELD = iter(())
+
+
+def _yield_once():
+    # a bare yield makes the task reschedule itself and lets the event loop
+    # run other callbacks or deliver a cancellation
+    yield
+
+
+class Checkpoint:
+    """Awaitable which gives control to the event loop. Outside the event loop
+    thread it does nothing.
+
+    Reading the clock on every loop iteration is expensive, so a background thread
+    sets the `due` flag once per interval instead, and the code checks it first:
+    `if __tgpy_checkpoint__.due: await __tgpy_checkpoint__`
+    """
+
+    __slots__ = ('due',)
+
+    def __init__(self):
+        self.due = False
+
+    def __await__(self):
+        self.due = False
+        # noinspection PyProtectedMember
+        if asyncio._get_running_loop() is None:
+            return _NO_YIELD
+        return _yield_once()
+
+
+checkpoint = Checkpoint()
+_ticker: threading.Thread | None = None
+
+
+def _tick():
+    while True:
+        interval = tgpy.api.config.get(INTERVAL_KEY) or DEFAULT_INTERVAL
+        time.sleep(interval / 1000)
+        checkpoint.due = True
+
+
+def install():
+    """Make the checkpoint available to evaluated code and start its timer"""
+    global _ticker
+    setattr(builtins, CHECKPOINT_NAME, checkpoint)
+    if _ticker is None:
+        _ticker = threading.Thread(target=_tick, name='tgpy-checkpoints', daemon=True)
+        _ticker.start()
+
+
+__all__ = ['CHECKPOINT_NAME', 'Checkpoint', 'checkpoint', 'install']
@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable
+
+from pyrogram.errors import FloodWait
+from pyrogram.types import Message
+
+logger = logging.getLogger(__name__)
+
+# edits per second and the burst size of a single chat and of all chats together
+CHAT_RATE = 1.0
+CHAT_BURST = 5
+GLOBAL_RATE = 5.0
+GLOBAL_BURST = 10
+# the interval between edits of a chat is doubled after a FloodWait and goes back
+# to the normal one by this factor after each successful edit
+FLOOD_BACKOFF = 2.0
+FLOOD_RECOVERY = 0.9
+MAX_INTERVAL = 60.0
+
+Render = Callable[[], Awaitable[Any]]
+
+
+class TokenBucket:
+    """Allows `burst` actions at once and one more every `interval` seconds"""
+
+    def __init__(self, rate: float, burst: float):
+        self.base_interval = 1 / rate
+        self.interval = self.base_interval
+        self.burst = burst
+        self.tokens = float(burst)
+        self.paused_until = 0.0
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        elapsed = max(0.0, now - max(self._updated, self.paused_until))
+        self.tokens = min(self.burst, self.tokens + elapsed / self.interval)
+        self._updated = max(now, self._updated)
+
+    def delay(self, now: float) -> float:
+        """Seconds until the next action is allowed"""
+        self._refill(now)
+        wait = max(0.0, self.paused_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) * self.interval)
+        return wait
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def slow_down(self, now: float, pause: float):
+        self.paused_until = max(self.paused_until, now + pause)
+        self.interval = min(MAX_INTERVAL, self.interval * FLOOD_BACKOFF)
+        self.tokens = min(self.tokens, 0.0)
+
+    def recover(self):
+        self.interval = max(self.base_interval, self.interval * FLOOD_RECOVERY)
+
+
+@dataclass
+class _Edit:
+    render: Render
+    not_before: float
+    future: asyncio.Future = field(repr=False)
+
+
+class EditScheduler:
+    """Sends message edits respecting per-chat and global rate limits.
+
+    Only the latest render of each message is sent: a render submitted while
+    an older one of the same message is waiting replaces it, and everyone who
+    awaits either of them gets the result of the one that was sent. Edits of
+    a single message are never sent concurrently.
+    """
+
+    def __init__(self):
+        self._pending: dict[tuple[int, int], _Edit] = {}
+        # edits being sent and their futures
+        self._in_flight: dict[tuple[int, int], asyncio.Future] = {}
+        self._chats: dict[int, TokenBucket] = {}
+        self._global = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self.submitted = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.flood_waits = 0
+        # edits skipped by the render because the message wouldn't change
+        self.suppressed = 0
+        self.max_latency = 0.0
+        self._total_latency = 0.0
+
+    def submit(
+        self, message: Message, render: Render, delay: float = 0.0
+    ) -> asyncio.Future:
+        """Schedule `render()` to be awaited in `delay` seconds or later"""
+        self._ensure_running()
+        now = time.monotonic()
+        key = (message.chat.id, message.id)
+        self.submitted += 1
+        if (edit := self._pending.get(key)) is not None:
+            self.coalesced += 1
+            edit.render = render
+            edit.not_before = min(edit.not_before, now + delay)
+        else:
+            edit = _Edit(render, now + delay, self._loop.create_future())
+            self._pending[key] = edit
+        self._wakeup.set()
+        return edit.future
+
+    def cancel(self, message: Message):
+        """Drop the pending edit of the message, if any"""
+        if (edit := self._pending.pop((message.chat.id, message.id), None)) is not None:
+            edit.future.cancel()
+
+    async def discard(self, message: Message):
+        """Drop the pending edit of the message and wait until the edit being
+        sent, if any, is done, so that it doesn't overwrite a direct edit made
+        afterwards"""
+        self.cancel(message)
+        if (future := self._in_flight.get((message.chat.id, message.id))) is not None:
+            await asyncio.wait([future])
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._task is not None and self._loop is loop and not self._task.done():
+            return
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self._run())
+
+    def _chat(self, chat_id: int) -> TokenBucket:
+        if (bucket := self._chats.get(chat_id)) is None:
+            bucket = self._chats[chat_id] = TokenBucket(CHAT_RATE, CHAT_BURST)
+        return bucket
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            timeout = None
+            # among the edits that can be sent, the one that is due the longest
+            ready: tuple[tuple[int, int], _Edit] | None = None
+            for key, edit in self._pending.items():
+                if key in self._in_flight:
+                    continue
+                wait = max(
+                    edit.not_before - now,
+                    self._chat(key[0]).delay(now),
+                    self._global.delay(now),
+                )
+                if wait > 0:
+                    if timeout is None or wait < timeout:
+                        timeout = wait
+                elif ready is None or edit.not_before < ready[1].not_before:
+                    ready = key, edit
+            if ready is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            key, edit = ready
+            del self._pending[key]
+            self._chat(key[0]).take(now)
+            self._global.take(now)
+            self._in_flight[key] = edit.future
+            self._loop.create_task(self._send(key, edit))
+
+    async def _send(self, key: tuple[int, int], edit: _Edit):
+        try:
+            result = await edit.render()
+        except FloodWait as e:
+            self.flood_waits += 1
+            logger.warning(f'Editing messages in chat {key[0]} is limited: {e}')
+            self._chat(key[0]).slow_down(time.monotonic(), e.value or 0)
+            if (newer := self._pending.get(key)) is not None:
+                # the newer render will be sent instead
+                newer.future.add_done_callback(lambda f: _copy_result(f, edit.future))
+            else:
+                self._pending[key] = edit
+        except asyncio.CancelledError:
+            edit.future.cancel()
+            raise
+        except Exception as e:
+            self.failed += 1
+            if not edit.future.done():
+                edit.future.set_exception(e)
+        else:
+            self.sent += 1
+            self._chat(key[0]).recover()
+            latency = max(0.0, time.monotonic() - edit.not_before)
+            self._total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            if not edit.future.done():
+                edit.future.set_result(result)
+        finally:
+            self._in_flight.pop(key, None)
+            self._wakeup.set()
+
+    @property
+    def metrics(self) -> dict[str, float]:
+        """Queue size, counters and how long edits wait after they are due"""
+        return {
+            'pending': len(self._pending),
+            'in_flight': len(self._in_flight),
+            'submitted': self.submitted,
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'failed': self.failed,
+            'flood_waits': self.flood_waits,
+            'suppressed': self.suppressed,
+            'avg_latency': self._total_latency / self.sent if self.sent else 0.0,
+            'max_latency': self.max_latency,
+        }
+
+
+def _copy_result(source: asyncio.Future, target: asyncio.Future):
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif (exc := source.exception()) is not None:
+        target.set_exception(exc)
+    else:
+        target.set_result(source.result())
+
+
+edit_scheduler = EditScheduler()
+
+__all__ = ['TokenBucket', 'EditScheduler', 'edit_scheduler']
@@ -6,9 +6,12 @@ from pyrogram.errors import MessageIdInvalid
 from pyrogram.types import Message
 
 from tgpy import app
-from tgpy._core import message_design
-from tgpy._core.utils import convert_result, format_traceback
+from tgpy._core import message_design, overflow
+from tgpy._core.edit_scheduler import edit_scheduler
+from tgpy._core.result_format import format_result
+from tgpy._core.utils import format_traceback
 from tgpy.api import constants, tgpy_eval
+from tgpy.context import ResourceLimitExceeded
 
 running_messages: dict[tuple[int, int], Task] = {}
 
@@ -23,9 +26,17 @@ async def eval_message(code: str, message: Message) -> Message | None:
     try:
         eval_result = await task
     except asyncio.CancelledError:
-        # message cancelled, do nothing
+        # message cancelled, drop the edits that weren't sent yet
         # return no message as it wasn't edited
+        edit_scheduler.cancel(message)
         return None
+    except ResourceLimitExceeded as e:
+        # a plain explanation instead of the traceback
+        result = str(e)
+        # noinspection PyProtectedMember
+        output = eval_ctx.run(lambda: app.ctx._output)
+        exc = ''
+        _, constants['exc'] = format_traceback()
     except Exception:
         result = None
         output = ''
@@ -33,23 +44,35 @@ async def eval_message(code: str, message: Message) -> Message | None:
     else:
         if eval_ctx.run(lambda: app.ctx.is_manual_output):
             return
-        result = convert_result(eval_result.result)
+        result = eval_result.result
         output = eval_result.output
         exc = ''
         constants['exc'] = None
     finally:
         running_messages.pop((message.chat.id, message.id))
 
+    # noinspection PyProtectedMember
+    document = overflow.build_document(
+        result,
+        eval_ctx.run(lambda: app.ctx._output_segments),
+        exc,
+        f'tgpy-{message.id}.txt',
+    )
     try:
-        return await message_design.edit_message(
+        edited = await message_design.edit_message(
             message,
             code,
-            result,
+            # only the part of the result that fits into the message is rendered.
+            # Falsy results are passed as is, so that the output replaces them
+            format_result(result, message_design.MESSAGE_LIMIT) if result else result,
             traceback=exc,
             output=output,
         )
     except MessageIdInvalid:
         return None
+    if document is not None:
+        await overflow.send_document(edited, document)
+    return edited
 
 
 __all__ = ['eval_message', 'running_messages']
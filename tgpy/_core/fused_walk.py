@@ -0,0 +1,194 @@
+import ast
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+_COMPREHENSIONS = (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+_SCOPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)
+
+# Scope of the node relative to the top-level code (the body of the eval function)
+_TOP = 0
+# inside a comprehension of the top-level code: only walrus targets bind there
+_COMPREHENSION = 1
+_NESTED = 2
+
+
+@dataclass
+class AstFacts:
+    """Facts about a tree collected while transforming it"""
+
+    # `orig` name is used anywhere
+    uses_orig: bool = False
+    # top-level code contains `return`
+    has_return: bool = False
+    # top-level code contains `await`, `async for` or `async with`
+    has_await: bool = False
+    # all names used anywhere in the tree
+    names: set[str] = field(default_factory=set)
+    # names bound by the top-level code, i.e. locals of the eval function
+    stored: set[str] = field(default_factory=set)
+    # names declared global or nonlocal in the top-level code
+    declared: set[str] = field(default_factory=set)
+
+    @property
+    def local_names(self) -> set[str]:
+        return self.stored - self.declared
+
+
+Callback = Callable[[ast.AST], Any]
+
+
+class FusedWalker:
+    """Runs post-order callbacks of several transformers and collects AstFacts
+    in a single traversal of the tree.
+
+    Callbacks are `visit_<NodeType>` methods of the passes. Each one is called after
+    the children of the node are processed and returns a replacement: a node,
+    a list of nodes or None to remove the node. Callbacks of all passes are applied
+    in order to the (possibly replaced) node. Nodes created by a callback are not
+    traversed again.
+    """
+
+    def __init__(self, passes: list[Any]):
+        self.passes = passes
+        self.facts = AstFacts()
+        self._callbacks: dict[type, tuple[tuple[int, Callback], ...]] = {}
+
+    def _get_callbacks(self, node_type: type) -> tuple[tuple[int, Callback], ...]:
+        try:
+            return self._callbacks[node_type]
+        except KeyError:
+            pass
+        method_name = 'visit_' + node_type.__name__
+        callbacks = tuple(
+            (i, getattr(p, method_name))
+            for i, p in enumerate(self.passes)
+            if hasattr(p, method_name)
+        )
+        self._callbacks[node_type] = callbacks
+        return callbacks
+
+    def walk(self, tree: ast.AST) -> ast.AST:
+        return self._visit(tree, _TOP)
+
+    def _visit(self, node: ast.AST, scope: int):
+        if isinstance(node, _SCOPES):
+            if scope == _TOP and not isinstance(node, ast.Lambda):
+                self.facts.stored.add(node.name)
+            for field_name, value in ast.iter_fields(node):
+                child_scope = scope if field_name == 'decorator_list' else _NESTED
+                self._visit_field(node, field_name, value, child_scope)
+        elif isinstance(node, _COMPREHENSIONS):
+            child_scope = _NESTED if scope == _NESTED else _COMPREHENSION
+            for field_name, value in ast.iter_fields(node):
+                self._visit_field(node, field_name, value, child_scope)
+        else:
+            for field_name, value in ast.iter_fields(node):
+                self._visit_field(node, field_name, value, scope)
+
+        result = self._apply(node, 0)
+        if isinstance(result, list):
+            for item in result:
+                self._collect(item, scope)
+        elif result is not None:
+            self._collect(result, scope)
+        return result
+
+    def _apply(self, node: ast.AST, start: int):
+        """Apply callbacks of passes starting from the given index to the node"""
+        for index, callback in self._get_callbacks(type(node)):
+            if index < start:
+                continue
+            new_node = callback(node)
+            if new_node is None:
+                return None
+            if isinstance(new_node, list):
+                result = []
+                for item in new_node:
+                    item = self._apply(item, index + 1)
+                    if isinstance(item, list):
+                        result.extend(item)
+                    elif item is not None:
+                        result.append(item)
+                return result
+            if type(new_node) is not type(node):
+                return self._apply(new_node, index + 1)
+            node = new_node
+        return node
+
+    def _visit_field(self, node: ast.AST, field_name: str, value, scope: int):
+        if isinstance(value, list):
+            new_values = []
+            for item in value:
+                if isinstance(item, ast.AST):
+                    if isinstance(item, ast.comprehension) and scope != _NESTED:
+                        item = self._visit_comprehension(item, scope)
+                    else:
+                        item = self._visit(item, scope)
+                    if item is None:
+                        continue
+                    elif isinstance(item, list):
+                        new_values.extend(item)
+                        continue
+                new_values.append(item)
+            value[:] = new_values
+        elif isinstance(value, ast.AST):
+            new_node = self._visit(value, scope)
+            if new_node is None:
+                delattr(node, field_name)
+            else:
+                setattr(node, field_name, new_node)
+
+    def _visit_comprehension(self, node: ast.comprehension, scope: int):
+        # loop targets of a comprehension belong to its own scope
+        node.target = self._visit(node.target, _NESTED)
+        node.iter = self._visit(node.iter, scope)
+        self._visit_field(node, 'ifs', node.ifs, scope)
+        if node.is_async:
+            self.facts.has_await = True
+        return self._apply(node, 0)
+
+    def _collect(self, node: ast.AST, scope: int):
+        facts = self.facts
+        if isinstance(node, ast.Name):
+            facts.names.add(node.id)
+            if node.id == 'orig':
+                facts.uses_orig = True
+            if scope == _TOP and not isinstance(node.ctx, ast.Load):
+                facts.stored.add(node.id)
+            return
+        if scope == _NESTED:
+            return
+        if isinstance(node, ast.NamedExpr) and isinstance(node.target, ast.Name):
+            facts.stored.add(node.target.id)
+        elif isinstance(node, (ast.Await, ast.AsyncFor, ast.AsyncWith)):
+            facts.has_await = True
+        if scope != _TOP:
+            return
+        if isinstance(node, ast.Return):
+            facts.has_return = True
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            facts.stored.update(
+                alias.asname or alias.name.partition('.')[0]
+                for alias in node.names
+                if alias.name != '*'
+            )
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            facts.declared.update(node.names)
+        elif isinstance(node, (ast.ExceptHandler, ast.MatchAs, ast.MatchStar)):
+            if node.name:
+                facts.stored.add(node.name)
+        elif isinstance(node, ast.MatchMapping) and node.rest:
+            facts.stored.add(node.rest)
+
+
+def fused_walk(tree: ast.AST, passes: list[Any]) -> tuple[ast.AST, AstFacts]:
+    walker = FusedWalker(passes)
+    tree = walker.walk(tree)
+    return tree, walker.facts
+
+
+def collect_facts(tree: ast.AST) -> AstFacts:
+    return fused_walk(tree, [])[1]
+
+
+__all__ = ['AstFacts', 'FusedWalker', 'fused_walk', 'collect_facts']
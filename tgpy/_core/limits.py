@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import os
+import re
+from dataclasses import dataclass
+
+import tgpy.api
+from tgpy._core.pragmas import parse_pragmas
+from tgpy.context import DEFAULT_MAX_SIZE, ResourceLimitExceeded
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT_KEY = 'core.limits.timeout'
+MEMORY_KEY = 'core.limits.memory'
+OUTPUT_MAX_SIZE_KEY = 'core.output.max_size'
+OUTPUT_KILL_ON_LIMIT_KEY = 'core.output.kill_on_limit'
+# how often the memory usage is checked, in seconds
+MEMORY_CHECK_INTERVAL = 0.2
+
+_SIZE_RE = re.compile(r'(?i)^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$')
+_SIZE_UNITS = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+_DURATION_RE = re.compile(r'(?i)^\s*(\d+(?:\.\d+)?)\s*(ms|s|m|h)?\s*$')
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def parse_size(value: int | str | None) -> int | None:
+    """Number of bytes or characters from a number or a string like `512M`.
+    0 and None mean no limit"""
+    if value is None or isinstance(value, int):
+        return value or None
+    if not (match := _SIZE_RE.match(value)):
+        raise ValueError(f'Invalid size: {value!r}')
+    return int(float(match[1]) * _SIZE_UNITS[match[2].lower()]) or None
+
+
+def parse_duration(value: float | str | None) -> float | None:
+    """Number of seconds from a number or a string like `1.5s` or `10m`.
+    0 and None mean no limit"""
+    if value is None or isinstance(value, (int, float)):
+        return value or None
+    if not (match := _DURATION_RE.match(value)):
+        raise ValueError(f'Invalid duration: {value!r}')
+    return float(match[1]) * _DURATION_UNITS[(match[2] or 's').lower()] or None
+
+
+def _format_size(size: int) -> str:
+    for unit in ('GiB', 'MiB', 'KiB'):
+        scale = _SIZE_UNITS[unit[0].lower()]
+        if size >= scale:
+            return f'{size / scale:g} {unit}'
+    return f'{size} bytes'
+
+
+@dataclass
+class Limits:
+    # seconds
+    timeout: float | None = None
+    # bytes the memory usage of TGPy may grow by while the code runs
+    memory: int | None = None
+    # characters of stdout and of stderr
+    output: int | None = DEFAULT_MAX_SIZE
+    kill_on_output_limit: bool = True
+
+
+def get_limits(code: str) -> Limits:
+    """Limits from the config, overridden by `# tgpy: timeout=... memory=...
+    output=...` pragmas"""
+    pragmas = parse_pragmas(code)
+    output = pragmas.get('output', tgpy.api.config.get(OUTPUT_MAX_SIZE_KEY))
+    return Limits(
+        timeout=parse_duration(
+            pragmas.get('timeout', tgpy.api.config.get(TIMEOUT_KEY))
+        ),
+        memory=parse_size(pragmas.get('memory', tgpy.api.config.get(MEMORY_KEY))),
+        output=DEFAULT_MAX_SIZE if output is None else parse_size(output),
+        kill_on_output_limit=tgpy.api.config.get(OUTPUT_KILL_ON_LIMIT_KEY) is not False,
+    )
+
+
+try:
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = 4096
+
+
+def get_rss() -> int | None:
+    """Resident memory of the process in bytes, None if it's unknown"""
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class LimitGuard:
+    """Cancels the current task when it runs out of time or memory, and turns
+    the cancellation into `ResourceLimitExceeded`.
+
+    The memory usage of the whole process is sampled, so other code running at
+    the same time counts too. Code which doesn't give control to the event loop
+    can't be stopped until it does: loops do it regularly thanks to loop
+    checkpoints. Code run by the thread and process backends keeps running in
+    the background after it's stopped, only its result is ignored.
+    """
+
+    def __init__(self, limits: Limits):
+        self.limits = limits
+        self.reason: str | None = None
+        self._task: asyncio.Task | None = None
+        self._cancelling = 0
+        self._timeout_handle: asyncio.TimerHandle | None = None
+        self._memory_handle: asyncio.TimerHandle | None = None
+        self._memory_base = 0
+
+    def __enter__(self):
+        self._task = asyncio.current_task()
+        self._cancelling = self._task.cancelling()
+        loop = asyncio.get_running_loop()
+        if self.limits.timeout:
+            self._timeout_handle = loop.call_later(
+                self.limits.timeout,
+                self._trip,
+                f'Time limit of {self.limits.timeout:g} s exceeded',
+            )
+        if self.limits.memory:
+            if (rss := get_rss()) is None:
+                logger.warning("Can't limit the memory: its usage is unknown")
+            else:
+                self._memory_base = rss
+                self._memory_handle = loop.call_later(
+                    MEMORY_CHECK_INTERVAL, self._check_memory
+                )
+        return self
+
+    def _check_memory(self):
+        if (rss := get_rss()) is not None and (
+            rss - self._memory_base > self.limits.memory
+        ):
+            self._trip(f'Memory limit of {_format_size(self.limits.memory)} exceeded')
+            return
+        self._memory_handle = asyncio.get_running_loop().call_later(
+            MEMORY_CHECK_INTERVAL, self._check_memory
+        )
+
+    def _trip(self, reason: str):
+        if self.reason is None:
+            self.reason = reason
+            self._task.cancel()
+
+    def __exit__(self, exc_type, exc, tb):
+        for handle in (self._timeout_handle, self._memory_handle):
+            if handle is not None:
+                handle.cancel()
+        if self.reason is not None and self._task.uncancel() <= self._cancelling:
+            if exc_type is asyncio.CancelledError:
+                raise ResourceLimitExceeded(self.reason) from None
+
+
+__all__ = [
+    'TIMEOUT_KEY',
+    'MEMORY_KEY',
+    'Limits',
+    'get_limits',
+    'get_rss',
+    'parse_duration',
+    'parse_size',
+    'LimitGuard',
+]
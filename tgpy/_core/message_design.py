@@ -1,38 +1,235 @@
+import asyncio
+import bisect
+import functools
+import re
 import sys
 import traceback as tb
 
 import pyrogram
 from pyrogram.enums import MessageEntityType, ParseMode
+from pyrogram.errors import MessageNotModified
 from pyrogram.raw.types import MessageEntityTextUrl
 from pyrogram.types import Message, MessageEntity
 
 from tgpy import app, reactions_fix
+from tgpy._core.edit_scheduler import edit_scheduler
+from tgpy._core.recent_messages import recent_messages
+from tgpy._core.utils import LRUCache
 
 TITLE = 'TGPy'
 RUNNING_TITLE = 'TGPy running'
 OLD_TITLE_URLS = ['https://github.com/tm-a-t/TGPy', 'https://tgpy.tmat.me/']
 TITLE_URL = 'https://tgpy.dev/'
 FORMATTED_ERROR_HEADER = '<b>TGPy error&gt;</b>'
+# Telegram's message length limit, in UTF-16 code units
+MESSAGE_LIMIT = 4096
+TRUNCATION_MARKER = '…'
+SEPARATOR = '\n\n'
+SEPARATOR_LEN = 2
+
+# fingerprint of the text and entities last sent to each message, and the result
+_last_renders = LRUCache(1024)
+
+
+# characters outside the BMP take two UTF-16 code units
+_ASTRAL_RE = re.compile('[\U00010000-\U0010ffff]')
+
+
+def utf16_len(text: str) -> int:
+    """Length of the text in UTF-16 code units, as Telegram counts it"""
+    if text.isascii():
+        return len(text)
+    return len(text.encode('utf-16-le')) // 2
+
+
+class Utf16Index:
+    """Converts between UTF-16 code unit offsets and str indices of a text.
+
+    The text is scanned once: offsets of BMP-only text are the same as indices,
+    otherwise the positions of astral characters are bisected.
+    """
+
+    __slots__ = ('text', '_astral', '_astral_units')
+
+    def __init__(self, text: str):
+        self.text = text
+        # str indices and UTF-16 offsets of astral characters
+        self._astral: list[int] = []
+        self._astral_units: list[int] = []
+        if utf16_len(text) != len(text):
+            for i, m in enumerate(_ASTRAL_RE.finditer(text)):
+                self._astral.append(m.start())
+                self._astral_units.append(m.start() + i)
+
+    def __len__(self) -> int:
+        return len(self.text) + len(self._astral)
+
+    def to_units(self, index: int) -> int:
+        """UTF-16 offset of the character with the given str index"""
+        if not self._astral:
+            return index
+        return index + bisect.bisect_left(self._astral, index)
+
+    def to_index(self, units: int) -> int:
+        """str index of the character at the given UTF-16 offset. An offset in the
+        middle of a surrogate pair points to the character itself"""
+        if not self._astral:
+            return units
+        return units - bisect.bisect_left(self._astral_units, units)
+
+    def slice(self, start: int | None = None, stop: int | None = None) -> str:
+        """Part of the text between the given UTF-16 offsets"""
+        if start is not None:
+            start = self.to_index(start)
+        if stop is not None:
+            stop = self.to_index(stop)
+        return self.text[start:stop]
+
+    def find(self, sub: str, start: int = 0) -> int:
+        """UTF-16 offset of the first occurrence of `sub` after `start`, or -1"""
+        index = self.text.find(sub, self.to_index(start))
+        return index if index == -1 else self.to_units(index)
 
 
 class Utf16CodepointsWrapper(str):
+    """str which is indexed and measured in UTF-16 code units"""
+
     def __len__(self):
-        return len(self.encode('utf-16-le')) // 2
+        return len(self._index)
+
+    @functools.cached_property
+    def _index(self) -> Utf16Index:
+        return Utf16Index(str(self))
 
     def __getitem__(self, item):
-        s = self.encode('utf-16-le')
         if isinstance(item, slice):
-            item = slice(
-                item.start * 2 if item.start else None,
-                item.stop * 2 if item.stop else None,
-                item.step * 2 if item.step else None,
-            )
-            s = s[item]
+            if item.step not in (None, 1):
+                raise ValueError('Slices with a step are not supported')
+            return self._index.slice(item.start or None, item.stop or None)
         elif isinstance(item, int):
-            s = s[item * 2 : item * 2 + 2]
+            return str.__getitem__(self, self._index.to_index(item))
         else:
             raise TypeError(f'{type(item)} is not supported')
-        return s.decode('utf-16-le')
+
+
+class MessageBuilder:
+    """Accumulates message text and its entities, measured in UTF-16 code units"""
+
+    def __init__(self):
+        self._parts: list[str] = []
+        self.length = 0
+        self.entities: list[MessageEntity] = []
+
+    def add(self, text: str, length: int | None = None, **entity) -> int:
+        """Append the text and, if entity fields are given, an entity covering it.
+        Returns the offset of the text
+        """
+        offset = self.length
+        if length is None:
+            length = utf16_len(text)
+        self._parts.append(text)
+        self.length += length
+        if entity and length:
+            self.entities.append(MessageEntity(offset=offset, length=length, **entity))
+        return offset
+
+    def build(self) -> str:
+        return ''.join(self._parts)
+
+
+def _share_budget(lengths: list[int], budget: int) -> list[int]:
+    """Split the budget between sections: sections shorter than an equal share are
+    kept whole, the rest of the budget is shared equally between the longer ones
+    """
+    allowed = [0] * len(lengths)
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    for done, i in enumerate(order):
+        allowed[i] = min(lengths[i], max(budget, 0) // (len(lengths) - done))
+        budget -= allowed[i]
+    return allowed
+
+
+def _truncate(text: Utf16Index, limit: int, keep_end: bool = False) -> tuple[str, int]:
+    """Cut the text to `limit` UTF-16 units including the truncation marker.
+    Returns the new text and its length
+    """
+    if len(text) <= limit:
+        return text.text, len(text)
+    if limit <= 0:
+        return '', 0
+    if keep_end:
+        start = text.to_index(len(text) - limit + 1)
+        # don't split a surrogate pair
+        start_units = text.to_units(start)
+        if start_units < len(text) - limit + 1:
+            start += 1
+            start_units = text.to_units(start)
+        return TRUNCATION_MARKER + text.text[start:], len(text) - start_units + 1
+    kept = text.slice(0, limit - 1)
+    return kept + TRUNCATION_MARKER, text.to_units(len(kept)) + 1
+
+
+def build_message(
+    code: str,
+    result: str,
+    traceback: str = '',
+    output: str = '',
+    is_running: bool = False,
+    result_monospaced: bool = True,
+    result_entities: list[MessageEntity] | None = None,
+) -> tuple[str, list[MessageEntity]]:
+    """Text and entities of a TGPy message which fit into the message length limit.
+
+    The code is kept whole when possible, the rest of the limit is shared between
+    the result, the output and the traceback. A truncated result keeps its
+    beginning, the output and the traceback keep their end.
+    """
+    title = (RUNNING_TITLE if is_running else TITLE) + '>'
+    code = Utf16Index(code.strip())
+    # a part longer than the limit is truncated anyway, so only the characters
+    # that can be shown are indexed
+    result = Utf16Index(result.strip()[: MESSAGE_LIMIT + 1])
+    sections = [
+        Utf16Index(x.strip()[-MESSAGE_LIMIT - 1 :]) for x in (output, traceback)
+    ]
+    sections = [x for x in sections if x.text]
+
+    # code, title line and separators between the sections
+    fixed = len(code) + utf16_len(title) + 1 + SEPARATOR_LEN * (len(sections) + 1)
+    code_limit = max(MESSAGE_LIMIT - fixed + len(code), 0)
+    budget = MESSAGE_LIMIT - fixed
+    result_limit, *section_limits = _share_budget(
+        [len(result), *map(len, sections)], budget
+    )
+
+    builder = MessageBuilder()
+    code_text, code_len = _truncate(code, code_limit)
+    builder.add(code_text, code_len, type=MessageEntityType.PRE, language='python')
+    builder.add(SEPARATOR, SEPARATOR_LEN)
+    builder.add(title, type=MessageEntityType.BOLD)
+    builder.add(' ', 1)
+
+    result_text, result_len = _truncate(result, result_limit)
+    if result_entities is not None:
+        offset = builder.add(result_text, result_len)
+        for e in result_entities:
+            if e.offset >= result_len:
+                continue
+            e.length = min(e.length, result_len - e.offset)
+            e.offset += offset
+            builder.entities.append(e)
+    elif result_monospaced:
+        builder.add(result_text, result_len, type=MessageEntityType.CODE)
+    else:
+        builder.add(result_text, result_len)
+
+    for section, limit in zip(sections, section_limits):
+        text, length = _truncate(section, limit, keep_end=True)
+        if not length:
+            continue
+        builder.add(SEPARATOR, SEPARATOR_LEN)
+        builder.add(text, length, type=MessageEntityType.CODE)
+    return builder.build(), builder.entities
 
 
 async def edit_message(
@@ -45,6 +242,43 @@ async def edit_message(
     result_monospaced: bool = True,
     result_entitites_rewrite: list[MessageEntity] | None = None,
 ) -> Message:
+    # edits go through the scheduler, which respects Telegram rate limits and
+    # skips outdated edits of the same message
+    future = edit_scheduler.submit(
+        message,
+        functools.partial(
+            render_message,
+            message,
+            code,
+            result,
+            traceback,
+            output,
+            is_running,
+            result_monospaced,
+            result_entitites_rewrite,
+        ),
+    )
+    try:
+        # other callers may wait for the same edit
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # e.g. the evaluation was cancelled: its edit must not be sent later
+        if not future.done():
+            edit_scheduler.cancel(message)
+        raise
+
+
+async def render_message(
+    message: Message,
+    code: str,
+    result: str = '',
+    traceback: str = '',
+    output: str = '',
+    is_running: bool = False,
+    result_monospaced: bool = True,
+    result_entitites_rewrite: list[MessageEntity] | None = None,
+) -> Message:
+    """Edit the message right away, without the scheduler"""
     if not result and output:
         result = output
         output = ''
@@ -52,141 +286,53 @@ async def edit_message(
         result = traceback
         traceback = ''
 
-    current_title = (RUNNING_TITLE if is_running else TITLE) + '>'
-
-    # Ensure all parts are Utf16CodepointsWrapper for consistent length calculation
-    code_part = Utf16CodepointsWrapper(code.strip())
-    # The title part itself should not be part of the entity that gets the language 'python'
-    # The structure is: code_part \n\n title_part result_part \n\n output_part \n\n traceback_part
-
-    title_text_part = Utf16CodepointsWrapper(current_title)
-    result_text_part = Utf16CodepointsWrapper(str(result).strip())
-
-    # Combined title and result for display line
-    display_line_after_code = Utf16CodepointsWrapper(
-        f'{title_text_part} {result_text_part}'
+    final_text_str, entities = build_message(
+        code,
+        str(result),
+        traceback,
+        output,
+        is_running,
+        result_monospaced,
+        result_entitites_rewrite,
     )
 
-    text_parts = [code_part, display_line_after_code]
-    if output.strip():
-        text_parts.append(Utf16CodepointsWrapper(output.strip()))
-    if traceback.strip():
-        text_parts.append(Utf16CodepointsWrapper(traceback.strip()))
-
-    entities = []
-    current_offset = 0
-
-    # Entity for code block (python)
-    entities.append(
-        MessageEntity(
-            offset=current_offset,
-            length=len(code_part),
-            type=MessageEntityType.PRE,
-            language='python',
-        )
-    )
-    current_offset += len(code_part) + 2  # +2 for \n\n
-
-    # Entities for the title part of the display line
-    title_offset_in_display_line = 0  # Title is at the start of display_line_after_code's construction before result
-
-    # Bold title
-    entities.append(
-        MessageEntity(
-            offset=current_offset + title_offset_in_display_line,
-            length=len(title_text_part),
-            type=MessageEntityType.BOLD,
-        )
-    )
-    # Clickable title
-    # entities.append(MessageEntity(
-    #     offset=current_offset + title_offset_in_display_line,
-    #     length=len(title_text_part),
-    #     type=MessageEntityType.TEXT_LINK,
-    #     url=TITLE_URL
-    # ))
-
-    # Entity for the result part (after title and a space)
-    result_offset_in_display_line = len(title_text_part) + 1  # +1 for space after title
-    if len(result_text_part) > 0:
-        if result_entitites_rewrite is not None:
-            for e in result_entitites_rewrite:
-                e.offset += current_offset + result_offset_in_display_line
-                entities.append(e)
-        elif result_monospaced:
-            entities.append(
-                MessageEntity(
-                    offset=current_offset + result_offset_in_display_line,
-                    length=len(result_text_part),
-                    type=MessageEntityType.CODE,  # Result is in a code block
-                )
-            )
-
-    current_offset += len(display_line_after_code) + 2  # +2 for \n\n
-
-    # Entities for output and traceback if they exist
-    if output.strip():
-        entities.append(
-            MessageEntity(
-                offset=current_offset,
-                length=len(text_parts[2]),  # output part
-                type=MessageEntityType.CODE,
-            )
-        )
-        current_offset += len(text_parts[2]) + 2  # +2 for \n\n
-
-    if traceback.strip():
-        # The last part might not have \n\n after it depending on construction
-        entities.append(
-            MessageEntity(
-                offset=current_offset,
-                length=len(
-                    text_parts[-1]
-                ),  # traceback part (or output if no traceback)
-                type=MessageEntityType.CODE,
-            )
-        )
-
-    # Construct final text
-    # First part (code) is followed by \n\n
-    # Second part (title + result) is followed by \n\n
-    # Subsequent parts (output, traceback) are also followed by \n\n, except the last one
-
-    final_text_str = code_part + '\n\n' + display_line_after_code
-    if output.strip():
-        final_text_str += '\n\n' + text_parts[2]
-    if traceback.strip():
-        final_text_str += (
-            '\n\n' + text_parts[-1]
-        )  # This will be traceback, or output if no traceback
-
-    if len(final_text_str) > 4096:  # Telegram's message length limit
-        # A more sophisticated truncation that preserves entities might be needed
-        # For now, simple string truncation. Pyrogram might handle entities with truncated text.
-        final_text_str = final_text_str[:4095] + '…'
-        # Adjust entities if truncation happens. This is complex.
-        # Pyrogram might handle this gracefully, or entities might become invalid.
-        # For simplicity, we'll rely on Pyrogram's behavior for now.
-        # A robust solution would filter/adjust entities whose offsets are beyond the new length.
-        valid_entities = []
-        for e in entities:
-            if e.offset < len(final_text_str):
-                e.length = min(e.length, len(final_text_str) - e.offset)
-                valid_entities.append(e)
-        entities = valid_entities
+    key = (message.chat.id, message.id)
+    fingerprint = hash((
+        final_text_str,
+        tuple(
+            (e.type, e.offset, e.length, e.language, e.url, e.custom_emoji_id)
+            for e in entities
+        ),
+    ))
+    if (last := _last_renders.get(key)) is not None and last[0] == fingerprint:
+        # the message already looks like this
+        edit_scheduler.suppressed += 1
+        return last[1]
 
     # Pyrogram's edit uses message.edit_text
-    res = await message.edit_text(
-        text=str(final_text_str),  # Ensure it's a plain str
-        entities=entities,
-        link_preview_options=pyrogram.types.LinkPreviewOptions(
-            is_disabled=True
-        ),  # Equivalent to link_preview=False
-    )
+    try:
+        res = await message.edit_text(
+            text=final_text_str,
+            entities=entities,
+            link_preview_options=pyrogram.types.LinkPreviewOptions(
+                is_disabled=True
+            ),  # Equivalent to link_preview=False
+        )
+    except MessageNotModified:
+        edit_scheduler.suppressed += 1
+        return message
     reactions_fix.update_hash(res, in_memory=False)  # Ensure res is Pyrogram Message
+    _last_renders.put(key, (fingerprint, res))
+    recent_messages.add(res)
     return res
 
 
+def forget_render(message: Message):
+    """Make the next edit of the message happen even if it renders the same,
+    e.g. after the message was edited by the user"""
+    _last_renders.pop((message.chat.id, message.id))
+
+
 def get_title_entity(message: Message) -> MessageEntityTextUrl | None:
     for e in message.entities or []:
         if isinstance(e, MessageEntityTextUrl) and (
@@ -230,7 +376,13 @@ async def send_error(
 
 __all__ = [
     'Utf16CodepointsWrapper',  # Added Utf16CodepointsWrapper to __all__
+    'Utf16Index',
+    'utf16_len',
     'edit_message',
+    'render_message',
+    'MessageBuilder',
+    'build_message',
+    'forget_render',
     'send_error',
     'get_title_entity',  # Added get_title_entity to __all__
 ]
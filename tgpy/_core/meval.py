@@ -1,16 +1,22 @@
 # forked from https://pypi.org/project/meval/
 
 import ast
+import asyncio
+import contextvars
 import inspect
-import sys
 from collections import deque
+from concurrent.futures import Executor
 from copy import deepcopy
 from importlib.abc import SourceLoader
 from importlib.util import module_from_spec, spec_from_loader
-from types import CodeType
-from typing import Any, Iterator
+from types import CodeType, FunctionType
+from typing import Any, Iterable, Iterator
 
+from tgpy._core.fused_walk import AstFacts, collect_facts
+from tgpy._core.source_registry import cache_max_bytes, code_size, source_registry
+from tgpy._core.utils import LRUCache
 from tgpy.api.parse_code import ParseResult
+from tgpy.api.transformers import ast_transformers, code_transformers
 
 
 def shallow_walk(node) -> Iterator:
@@ -48,29 +54,37 @@ class MevalLoader(SourceLoader):
         return self.code
 
 
-async def _meval(
-    parsed: ParseResult, filename: str, saved_variables: dict, **kwargs
-) -> (dict, Any):
-    kwargs.update(saved_variables)
+# compiled eval functions and their ret-names
+compile_cache = LRUCache(256, cache_max_bytes)
+
+
+def _with_filename(code: CodeType, filename: str) -> CodeType:
+    # Cached code may have been compiled for another message,
+    # retarget it (and all nested functions) so that tracebacks point to the right place
+    if code.co_filename == filename:
+        return code
+    return code.replace(
+        co_filename=filename,
+        co_consts=tuple(
+            _with_filename(const, filename) if isinstance(const, CodeType) else const
+            for const in code.co_consts
+        ),
+    )
 
-    root = deepcopy(parsed.tree)
+
+def _compile(
+    parsed: ParseResult, facts: AstFacts, filename: str, arg_names: Iterable[str]
+) -> tuple[CodeType, str]:
     ret_name = '_ret'
-    ok = False
-    while True:
-        if ret_name in kwargs.keys():
-            ret_name = '_' + ret_name
-            continue
-        for node in ast.walk(root):
-            if isinstance(node, ast.Name) and node.id == ret_name:
-                ret_name = '_' + ret_name
-                break
-            ok = True
-        if ok:
-            break
-
-    code = root.body
-    if not code:
-        return {}, None
+    while ret_name in arg_names or ret_name in facts.names:
+        ret_name = '_' + ret_name
+
+    if facts.has_return:
+        # return statements are rewritten in place
+        root = deepcopy(parsed.tree)
+    else:
+        root = parsed.tree
+    code = list(root.body)
 
     # _ret = []
     ret_decl = ast.Assign(
@@ -95,7 +109,7 @@ async def _meval(
         keywords=[],
     )
 
-    if not any(isinstance(node, ast.Return) for node in shallow_walk(root)):
+    if not facts.has_return:
         for i in range(len(code)):
             if (
                 not isinstance(code[i], ast.Expr)
@@ -149,7 +163,7 @@ async def _meval(
     )
 
     args = []
-    for a in list(map(lambda x: ast.arg(x, None), kwargs.keys())):
+    for a in list(map(lambda x: ast.arg(x, None), arg_names)):
         ast.fix_missing_locations(a)
         args += [a]
     args = ast.arguments(
@@ -168,15 +182,108 @@ async def _meval(
     mod = ast.Module(body=[fun], type_ignores=[])
 
     # print(ast.unparse(mod))
-    comp = compile(mod, filename, 'exec')
+    return compile(mod, filename, 'exec'), ret_name
+
+
+def _run_sync(func, kwargs: dict) -> Any:
+    # the eval function of code without top-level await finishes on the first step
+    coro = func(**kwargs)
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    coro.close()
+    raise RuntimeError('Code awaited something while running in a thread')
+
+
+async def _run_in_executor(executor: Executor, func, kwargs: dict) -> Any:
+    """Run the eval function of synchronous code in the executor.
+    Context variables are copied to the thread and their changes are copied back
+    """
+    ctx = contextvars.copy_context()
+    result = await asyncio.get_running_loop().run_in_executor(
+        executor, ctx.run, _run_sync, func, kwargs
+    )
+    missing = object()
+    for var, value in ctx.items():
+        if var.get(missing) is not value:
+            var.set(value)
+    return result
+
+
+async def _meval(
+    parsed: ParseResult,
+    filename: str,
+    saved_variables: dict,
+    *,
+    namespace: dict | None = None,
+    executor: Executor | None = None,
+    **kwargs,
+) -> (dict, Any):
+    """Evaluate parsed code and return new variables and the result.
+
+    By default, every saved variable and every keyword argument is passed to the eval
+    function as a keyword-only argument. If `namespace` is given, the function is instead
+    executed with `namespace` as its globals, and only keyword arguments and those
+    namespace names which the code assigns to are passed as arguments.
+
+    If `executor` is given, code without top-level await runs in it. Awaitables it
+    returns are still awaited in the event loop.
+    """
+    if namespace is None:
+        kwargs.update(saved_variables)
+
+    facts = parsed.facts or collect_facts(parsed.tree)
+    if namespace is None:
+        arg_names = kwargs.keys()
+    else:
+        arg_names = kwargs.keys() | (facts.local_names & namespace.keys())
+
+    cache_key = (
+        parsed.transformed,
+        frozenset(arg_names),
+        code_transformers.version,
+        ast_transformers.version,
+    )
+    cached = compile_cache.get(cache_key)
+    if cached is None:
+        # the tree is only accessed on a cache miss, as results of parse_code
+        # copy it lazily
+        if parsed.tree.body:
+            cached = _compile(parsed, facts, filename, arg_names)
+            # the key keeps the transformed source
+            size = len(parsed.transformed.encode('utf-8')) + code_size(cached[0])
+        else:
+            cached = (None, None)
+            size = 0
+        compile_cache.put(cache_key, cached, size)
+    comp, ret_name = cached
+    if comp is None:
+        return {}, None
+    comp = _with_filename(comp, filename)
+
     loader = MevalLoader(parsed.original, comp, filename)
     py_module = module_from_spec(spec_from_loader(filename, loader, origin=filename))
-    sys.modules[filename] = py_module
-    loader.exec_module(py_module)
+    source_registry.register(filename, parsed.original, comp, py_module)
+    if namespace is None:
+        loader.exec_module(py_module)
+        func = py_module.tmp
+    else:
+        # the module only defines the eval function. It's created right away
+        # with the namespace as its globals, so the module code doesn't run
+        # there and can't overwrite a saved variable called `tmp`
+        func = FunctionType(
+            next(x for x in comp.co_consts if isinstance(x, CodeType)), namespace
+        )
+        kwargs.update({name: namespace[name] for name in arg_names - kwargs.keys()})
 
-    new_locs, ret = await getattr(py_module, 'tmp')(**kwargs)
+    if executor is not None and not facts.has_await:
+        new_locs, ret = await _run_in_executor(executor, func, kwargs)
+    else:
+        new_locs, ret = await func(**kwargs)
     for loc in list(new_locs):
-        if (loc in kwargs or loc == ret_name) and loc not in saved_variables:
+        provided = loc in kwargs or namespace is not None and loc in namespace
+        if (provided or loc == ret_name) and loc not in saved_variables:
             new_locs.pop(loc)
 
     ret = [await el if inspect.isawaitable(el) else el for el in ret]
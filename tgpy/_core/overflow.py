@@ -0,0 +1,161 @@
+import bisect
+import io
+import logging
+import os
+import threading
+from typing import Any, BinaryIO
+
+from pyrogram.types import Message
+
+import tgpy.api
+from tgpy._core.result_format import format_result
+
+logger = logging.getLogger(__name__)
+
+ENABLED_KEY = 'core.overflow.enabled'
+THRESHOLD_KEY = 'core.overflow.threshold'
+MAX_SIZE_KEY = 'core.overflow.max_size'
+# documents are sent when the result, output and traceback take more bytes than this
+DEFAULT_THRESHOLD = 4096
+DEFAULT_MAX_SIZE = 50 * 1024 * 1024
+
+Segment = bytes | tuple[BinaryIO, int]
+
+
+def _segment_size(segment: Segment) -> int:
+    return len(segment) if isinstance(segment, bytes) else segment[1]
+
+
+class SegmentedReader(io.RawIOBase):
+    """Read-only binary file which joins pieces of memory and ranges of other files
+    without copying them.
+
+    Files are read with `os.pread`, so their positions are not changed. Where
+    there is no `os.pread` (on Windows), they are read with `seek` and `read`
+    under a lock, and their positions are restored.
+    """
+
+    # shared by all readers, as different documents may read the same file
+    _file_lock = threading.Lock()
+
+    def __init__(self, segments: list[Segment], name: str):
+        super().__init__()
+        self.name = name
+        self._segments = [x for x in segments if _segment_size(x)]
+        self._starts = []
+        self.size = 0
+        for segment in self._segments:
+            self._starts.append(self.size)
+            self.size += _segment_size(segment)
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < len(view) and self._pos < self.size:
+            i = bisect.bisect_right(self._starts, self._pos) - 1
+            segment = self._segments[i]
+            start = self._pos - self._starts[i]
+            count = min(len(view) - filled, _segment_size(segment) - start)
+            if isinstance(segment, bytes):
+                data = segment[start : start + count]
+            else:
+                data = self._read_file(segment[0], count, start)
+            view[filled : filled + len(data)] = data
+            filled += len(data)
+            self._pos += len(data)
+            if len(data) < count:
+                # the file is shorter than expected
+                break
+        return filled
+
+    def _read_file(self, file: BinaryIO, count: int, offset: int) -> bytes:
+        if hasattr(os, 'pread'):
+            return os.pread(file.fileno(), count, offset)
+        with self._file_lock:
+            position = file.tell()
+            try:
+                file.seek(offset)
+                return file.read(count)
+            finally:
+                file.seek(position)
+
+
+def _warn_too_large(name: str, size: str, max_size: int):
+    logger.warning(
+        f'Not sending the output of {name}: {size} bytes, {MAX_SIZE_KEY} is {max_size}'
+    )
+
+
+def build_document(
+    result: Any, output: list[Segment], traceback: str, name: str
+) -> SegmentedReader | None:
+    """Full result, output and traceback of the code as a text document, if they
+    are longer than the overflow threshold and overflow documents are enabled
+    """
+    if not tgpy.api.config.get(ENABLED_KEY):
+        return None
+    threshold = tgpy.api.config.get(THRESHOLD_KEY) or DEFAULT_THRESHOLD
+    max_size = tgpy.api.config.get(MAX_SIZE_KEY) or DEFAULT_MAX_SIZE
+    traceback_part = [traceback.encode('utf-8', 'surrogatepass')] if traceback else []
+    rest_size = sum(map(_segment_size, output + traceback_part))
+    if rest_size > max_size:
+        _warn_too_large(name, str(rest_size), max_size)
+        return None
+    if result is not None:
+        # the message only renders the beginning of the result, here it's rendered
+        # up to the space left. A character takes at least one byte, so a render
+        # which doesn't fit into as many characters doesn't fit into the bytes either
+        limit = max_size - rest_size
+        result = format_result(result, limit)
+        if len(result) > limit:
+            _warn_too_large(name, f'over {max_size}', max_size)
+            return None
+    parts = [
+        [result.encode('utf-8', 'surrogatepass')] if result else [],
+        output,
+        traceback_part,
+    ]
+    segments = []
+    for part in parts:
+        if not sum(map(_segment_size, part)):
+            continue
+        if segments:
+            segments.append(b'\n\n')
+        segments.extend(part)
+    document = SegmentedReader(segments, name)
+    if document.size <= threshold:
+        return None
+    if document.size > max_size:
+        _warn_too_large(name, str(document.size), max_size)
+        return None
+    return document
+
+
+async def send_document(message: Message, document: SegmentedReader) -> Message | None:
+    """Send the document as a reply to the message"""
+    try:
+        return await message.reply_document(document, file_name=document.name)
+    except Exception:
+        logger.exception('Failed to send the output document')
+        return None
+
+
+__all__ = ['SegmentedReader', 'build_document', 'send_document']
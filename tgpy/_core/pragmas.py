@@ -0,0 +1,21 @@
+import re
+
+# leading comment lines like `# tgpy: backend=process timeout=10`
+PRAGMA_RE = re.compile(r'^[ \t]*#[ \t]*tgpy:(.*)$')
+OPTION_RE = re.compile(r'([\w.-]+)[ \t]*=[ \t]*([^\s,]+)')
+
+
+def parse_pragmas(code: str) -> dict[str, str]:
+    """Collect `key=value` options from the comments at the beginning of the code"""
+    options = {}
+    for line in code.splitlines():
+        if not line.strip():
+            continue
+        if not line.lstrip().startswith('#'):
+            break
+        if match := PRAGMA_RE.match(line):
+            options.update(OPTION_RE.findall(match[1]))
+    return options
+
+
+__all__ = ['parse_pragmas']
@@ -0,0 +1,55 @@
+import keyword
+import re
+import unicodedata
+
+# everything after the first quote or '#' may be inside a string or a comment
+_STOP_RE = re.compile('[\'"#]')
+# characters which can't appear outside strings and comments
+_INVALID_CHAR_RE = re.compile(r'[$?`]|!(?!=)')
+_TOKEN_RE = re.compile(
+    # numbers, including ones like 1e5, 0x1f and 1_000
+    r'(?P<number>\.?[0-9][0-9A-Za-z_.]*)'
+    # identifiers and runs of non-ASCII characters, which the tokenizer
+    # treats as identifiers until verifying them
+    r'|(?P<name>[A-Za-z_\x80-\U0010ffff][0-9A-Za-z_\x80-\U0010ffff]*)'
+)
+_BLANK_RE = re.compile(r'[ \t]+')
+# two names separated by spaces are valid only if one of them is a keyword
+_KEYWORDS = frozenset(keyword.kwlist + keyword.softkwlist + ['type'])
+
+
+def definitely_not_code(text: str) -> bool:
+    """Return True if ast.parse would certainly raise a SyntaxError on the text.
+
+    Only the beginning of the text which can't be inside a string or a comment is
+    checked, so False means that the text has to go through the full pipeline.
+    """
+    if stop := _STOP_RE.search(text):
+        text = text[: stop.start()]
+    if _INVALID_CHAR_RE.search(text):
+        return True
+
+    prev_name = None
+    prev_end = -1
+    for match in _TOKEN_RE.finditer(text):
+        name = match['name']
+        if name is None:
+            prev_name = None
+            continue
+        if not name.isascii():
+            if not name.isidentifier():
+                # e.g. emoji, dashes, guillemets or non-breaking spaces
+                return True
+            name = unicodedata.normalize('NFKC', name)
+        if (
+            prev_name is not None
+            and name not in _KEYWORDS
+            and _BLANK_RE.fullmatch(text, prev_end, match.start())
+        ):
+            return True
+        prev_name = None if name in _KEYWORDS else name
+        prev_end = match.end()
+    return False
+
+
+__all__ = ['definitely_not_code']
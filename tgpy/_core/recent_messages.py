@@ -0,0 +1,66 @@
+from pyrogram.types import Message
+
+from tgpy._core.utils import LRUCache
+
+# how many TGPy messages are remembered in each chat and in each thread
+RING_SIZE = 16
+# how many chats and threads are remembered
+MAX_RINGS = 1024
+
+
+class RecentMessages:
+    """Latest known versions of recently rendered TGPy messages, by chat and by
+    thread (topic or comment section), so that commands like `cancel` can find
+    them without requesting the chat history.
+
+    Each chat and thread keeps at most `ring_size` messages with the largest ids.
+    """
+
+    def __init__(self, ring_size: int = RING_SIZE, max_rings: int = MAX_RINGS):
+        self.ring_size = ring_size
+        # (chat id, thread id or None) -> message id -> message
+        self._rings = LRUCache(max_rings)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _ring_keys(message: Message) -> list[tuple[int, int | None]]:
+        keys = [(message.chat.id, None)]
+        if thread_id := getattr(message, 'message_thread_id', None):
+            keys.append((message.chat.id, thread_id))
+        return keys
+
+    def add(self, message: Message):
+        for key in self._ring_keys(message):
+            if (ring := self._rings.get(key)) is None:
+                ring = {}
+                self._rings.put(key, ring)
+            ring[message.id] = message
+            if len(ring) > self.ring_size:
+                del ring[min(ring)]
+
+    def discard(self, message: Message):
+        """Forget the message, e.g. after it stopped being a TGPy message"""
+        for key in self._ring_keys(message):
+            if (ring := self._rings.get(key)) is not None:
+                ring.pop(message.id, None)
+                if not ring:
+                    self._rings.pop(key)
+
+    def latest(
+        self, chat_id: int, thread_id: int | None = None, before: int | None = None
+    ) -> Message | None:
+        """The TGPy message with the largest id below `before` in the chat, or in
+        the thread if `thread_id` is given"""
+        ring = self._rings.get((chat_id, thread_id))
+        ids = [x for x in ring or () if before is None or x < before]
+        if not ids:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return ring[max(ids)]
+
+
+recent_messages = RecentMessages()
+
+__all__ = ['RecentMessages', 'recent_messages']
@@ -0,0 +1,152 @@
+import json
+from typing import Any
+
+from pyrogram.types.object import Object as PyrogramObject
+
+from tgpy._core.message_design import TRUNCATION_MARKER
+
+
+class _BudgetExhausted(Exception):
+    pass
+
+
+class _Writer:
+    __slots__ = ('parts', 'size', 'limit')
+
+    def __init__(self, limit: int | None):
+        self.parts: list[str] = []
+        self.size = 0
+        self.limit = limit
+
+    @property
+    def remaining(self) -> int | None:
+        return None if self.limit is None else self.limit - self.size
+
+    def write(self, s: str):
+        if self.limit is not None and self.size + len(s) > self.limit:
+            self.parts.append(s[: self.limit - self.size])
+            self.size = self.limit
+            raise _BudgetExhausted
+        self.parts.append(s)
+        self.size += len(s)
+
+
+def _write_items(writer: _Writer, items, seen: set[int]):
+    for i, item in enumerate(items):
+        if i:
+            writer.write(', ')
+        _write_repr(writer, item, seen)
+
+
+def _write_repr(writer: _Writer, obj: Any, seen: set[int]):
+    t = type(obj)
+    if t is str or t is bytes:
+        remaining = writer.remaining
+        if remaining is None or len(obj) <= remaining:
+            writer.write(repr(obj))
+            return
+        # the repr of the beginning is enough to fill the budget, but repr
+        # chooses quotes by the whole string
+        text = repr(obj[:remaining])
+        quote = "'"
+        if (t is str and "'" in obj and '"' not in obj) or (
+            t is bytes and b"'" in obj and b'"' not in obj
+        ):
+            quote = '"'
+        if text[-1] != quote:
+            # the beginning has no double quotes, and single quotes are escaped
+            # when the whole string has both
+            start = text.index(text[-1])
+            content = text[start + 1 : -1]
+            if quote == "'":
+                content = content.replace("'", "\\'")
+            text = text[:start] + quote + content + quote
+        writer.write(text)
+        return
+    if t not in (list, tuple, dict, set, frozenset) and not (
+        isinstance(obj, PyrogramObject) and t.__repr__ is PyrogramObject.__repr__
+    ):
+        writer.write(repr(obj))
+        return
+
+    if id(obj) in seen:
+        writer.write('{...}' if t is dict else '[...]')
+        return
+    seen.add(id(obj))
+    try:
+        if t is list:
+            writer.write('[')
+            _write_items(writer, obj, seen)
+            writer.write(']')
+        elif t is tuple:
+            writer.write('(')
+            _write_items(writer, obj, seen)
+            writer.write(',)' if len(obj) == 1 else ')')
+        elif t is dict:
+            writer.write('{')
+            for i, (key, value) in enumerate(obj.items()):
+                if i:
+                    writer.write(', ')
+                _write_repr(writer, key, seen)
+                writer.write(': ')
+                _write_repr(writer, value, seen)
+            writer.write('}')
+        elif t is set or t is frozenset:
+            if not obj:
+                writer.write(f'{t.__name__}()')
+                return
+            writer.write('{' if t is set else 'frozenset({')
+            _write_items(writer, obj, seen)
+            writer.write('}' if t is set else '})')
+        else:
+            # same as PyrogramObject.__repr__
+            writer.write(f'pyrogram.types.{t.__name__}(')
+            first = True
+            for attr in obj.__dict__:
+                if attr.startswith('_') or (value := getattr(obj, attr)) is None:
+                    continue
+                writer.write(f'{attr}=' if first else f', {attr}=')
+                _write_repr(writer, value, seen)
+                first = False
+            writer.write(')')
+    finally:
+        seen.discard(id(obj))
+
+
+def _write_str(writer: _Writer, obj: Any):
+    t = type(obj)
+    if t is str:
+        writer.write(obj if writer.limit is None else obj[: writer.limit + 1])
+    elif isinstance(obj, PyrogramObject) and t.__str__ is PyrogramObject.__str__:
+        # PyrogramObject.__str__ is json.dumps with these arguments, and the pure
+        # Python encoder used with indent produces the JSON lazily
+        encoder = json.JSONEncoder(
+            indent=4, default=PyrogramObject.default, ensure_ascii=False
+        )
+        for chunk in encoder.iterencode(obj):
+            writer.write(chunk)
+    elif t in (list, tuple, dict, set, frozenset):
+        _write_repr(writer, obj, set())
+    else:
+        writer.write(str(obj))
+
+
+def format_result(result: Any, limit: int | None = None) -> str:
+    """`str()` of an evaluation result, as `convert_result` would show it.
+
+    With a limit, rendering of lists, tuples, dicts, sets and Pyrogram objects
+    stops after `limit` characters, so a huge result doesn't have to be rendered
+    whole only to be truncated. The truncated text ends with the truncation marker.
+    Other objects are rendered with their own `__str__` and cut afterwards.
+    """
+    if isinstance(result, PyrogramObject) and hasattr(result, 'to_dict'):
+        result = result.to_dict()
+    writer = _Writer(limit)
+    try:
+        _write_str(writer, result)
+    except _BudgetExhausted:
+        return ''.join(writer.parts) + TRUNCATION_MARKER
+    return ''.join(writer.parts)
+
+
+__all__ = ['format_result']
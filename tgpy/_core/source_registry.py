@@ -0,0 +1,138 @@
+import linecache
+import sys
+from collections import OrderedDict
+from dataclasses import dataclass
+from types import CodeType, ModuleType
+
+import tgpy.api
+from tgpy.utils import FILENAME_PREFIX
+
+MAX_ENTRIES_KEY = 'core.eval.registry.max_entries'
+MAX_BYTES_KEY = 'core.eval.registry.max_bytes'
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+# the parse and compile caches keep sources, trees and code objects too
+CACHE_MAX_BYTES_KEY = 'core.eval.cache.max_bytes'
+DEFAULT_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# only sources of messages and tgpy_eval calls are evicted,
+# modules stay registered for the whole lifetime of the process
+EVICTABLE_PREFIXES = (f'{FILENAME_PREFIX}message/', f'{FILENAME_PREFIX}eval/')
+
+
+def code_size(code: CodeType) -> int:
+    return sys.getsizeof(code) + sum(
+        code_size(const) for const in code.co_consts if isinstance(const, CodeType)
+    )
+
+
+def cache_max_bytes() -> int:
+    """Memory limit of each of the parse and compile caches"""
+    return tgpy.api.config.get(CACHE_MAX_BYTES_KEY) or DEFAULT_CACHE_MAX_BYTES
+
+
+@dataclass
+class _Entry:
+    module: ModuleType
+    source_size: int
+    code_size: int
+
+    @property
+    def size(self) -> int:
+        return self.source_size + self.code_size
+
+
+class SourceRegistry:
+    """Registry of tgpy:// pseudo-modules with count- and size-based eviction.
+
+    Registered sources are put into sys.modules and linecache, so that tracebacks and
+    inspect.getsource work for recently evaluated code.
+    """
+
+    def __init__(self):
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._evictable_size = 0
+        self._evictable_count = 0
+        self.evicted = 0
+
+    @staticmethod
+    def _is_evictable(filename: str) -> bool:
+        return filename.startswith(EVICTABLE_PREFIXES)
+
+    def register(
+        self, filename: str, source: str, code: CodeType, module: ModuleType
+    ) -> None:
+        self._remove(filename)
+        entry = _Entry(module, len(source.encode('utf-8')), code_size(code))
+        self._entries[filename] = entry
+        if self._is_evictable(filename):
+            self._evictable_count += 1
+            self._evictable_size += entry.size
+        sys.modules[filename] = module
+        # Frames of the eval function may run with globals of another module
+        # (see namespace mode), so linecache can't rely on __loader__
+        # and has to know the source beforehand
+        lines = source.splitlines(keepends=True)
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        linecache.cache[filename] = (len(source), None, lines, filename)
+        self._evict()
+
+    def _remove(self, filename: str) -> _Entry | None:
+        entry = self._entries.pop(filename, None)
+        if entry is None:
+            return None
+        if self._is_evictable(filename):
+            self._evictable_count -= 1
+            self._evictable_size -= entry.size
+        if sys.modules.get(filename) is entry.module:
+            del sys.modules[filename]
+        linecache.cache.pop(filename, None)
+        return entry
+
+    def _evict(self):
+        max_entries = tgpy.api.config.get(MAX_ENTRIES_KEY) or DEFAULT_MAX_ENTRIES
+        max_bytes = tgpy.api.config.get(MAX_BYTES_KEY) or DEFAULT_MAX_BYTES
+        if self._evictable_count <= max_entries and self._evictable_size <= max_bytes:
+            return
+        for filename in list(self._entries):
+            if (
+                self._evictable_count <= max_entries
+                and self._evictable_size <= max_bytes
+            ):
+                break
+            if self._is_evictable(filename):
+                self._remove(filename)
+                self.evicted += 1
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def memory_usage(self) -> dict[str, int]:
+        """Approximate memory held by registered sources and code objects, in bytes"""
+        return {
+            'entries': len(self._entries),
+            'evictable_entries': self._evictable_count,
+            'evicted': self.evicted,
+            'source_bytes': sum(e.source_size for e in self._entries.values()),
+            'code_bytes': sum(e.code_size for e in self._entries.values()),
+            'evictable_bytes': self._evictable_size,
+        }
+
+    def __repr__(self):
+        usage = ', '.join(f'{k}={v}' for k, v in self.memory_usage().items())
+        return f'SourceRegistry({usage})'
+
+
+source_registry = SourceRegistry()
+
+__all__ = [
+    'CACHE_MAX_BYTES_KEY',
+    'SourceRegistry',
+    'cache_max_bytes',
+    'code_size',
+    'source_registry',
+]
@@ -1,5 +1,7 @@
 import sys
 import traceback
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
 
 from pyrogram.types.object import Object as PyrogramObject
 
@@ -13,10 +15,155 @@ def convert_result(result):
     return result
 
 
+# traceback of an exception raised in another process, formatted there
+REMOTE_TRACEBACK_ATTR = '_tgpy_remote_traceback'
+
+
 def format_traceback() -> tuple[str, str]:
     _, exc_value, exc_traceback = sys.exc_info()
     exc_traceback = exc_traceback.tb_next.tb_next
     te = traceback.TracebackException(
         type(exc_value), exc_value, exc_traceback, compact=True
     )
+    if (
+        remote_traceback := getattr(exc_value, REMOTE_TRACEBACK_ATTR, None)
+    ) is not None:
+        return ''.join(te.format_exception_only()), remote_traceback
     return ''.join(te.format_exception_only()), ''.join(te.format())
+
+
+class LRUCache:
+    """Bounded mapping which drops least recently used items, with hit/miss counters.
+
+    Besides the number of items, the approximate memory they hold may be limited
+    by `max_bytes`, a number or a function returning it. Items are sized by
+    `put`, and an item larger than the limit is not cached at all.
+    """
+
+    def __init__(self, maxsize: int, max_bytes: int | Callable[[], int] | None = None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._data: OrderedDict[Hashable, Any] = OrderedDict()
+        self._sizes: dict[Hashable, int] = {}
+
+    def get(self, key: Hashable) -> Any | None:
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any, size: int = 0):
+        """Cache the value. `size` is the memory it holds, in bytes"""
+        max_bytes = self.max_bytes() if callable(self.max_bytes) else self.max_bytes
+        self.pop(key)
+        if max_bytes is not None and size > max_bytes:
+            return
+        self._data[key] = value
+        if size:
+            self._sizes[key] = size
+            self.bytes += size
+        while len(self._data) > self.maxsize or (
+            max_bytes is not None and self.bytes > max_bytes
+        ):
+            self.bytes -= self._sizes.pop(self._data.popitem(last=False)[0], 0)
+
+    def pop(self, key: Hashable) -> Any | None:
+        self.bytes -= self._sizes.pop(key, 0)
+        return self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+        self._sizes.clear()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return (
+            f'LRUCache(size={len(self)}, maxsize={self.maxsize}, bytes={self.bytes}, '
+            f'hits={self.hits}, misses={self.misses})'
+        )
+
+
+Observer = Callable[[Hashable, Any, bool], Any]
+
+
+class ObservableDict(dict):
+    """dict which counts its mutations and notifies observers about them.
+
+    `version` changes on every mutation and `names_version` only when keys are added
+    or removed. Observers are called as `observer(key, value, deleted)` after a key
+    is set or deleted.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = 0
+        self.names_version = 0
+        self._observers: list[Observer] = []
+
+    def add_observer(self, observer: Observer):
+        self._observers.append(observer)
+
+    def remove_observer(self, observer: Observer):
+        self._observers.remove(observer)
+
+    def _changed(self, key: Hashable, value: Any, deleted: bool, new_name: bool):
+        self.version += 1
+        if new_name:
+            self.names_version += 1
+        for observer in self._observers:
+            observer(key, value, deleted)
+
+    def __setitem__(self, key: Hashable, value: Any):
+        new_name = key not in self
+        super().__setitem__(key, value)
+        self._changed(key, value, False, new_name)
+
+    def __delitem__(self, key: Hashable):
+        value = self[key]
+        super().__delitem__(key)
+        self._changed(key, value, True, True)
+
+    def pop(self, key: Hashable, *default):
+        if key not in self:
+            return super().pop(key, *default)
+        value = super().pop(key)
+        self._changed(key, value, True, True)
+        return value
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._changed(key, value, True, True)
+        return key, value
+
+    def setdefault(self, key: Hashable, default: Any = None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, other=(), /, **kwargs):
+        if hasattr(other, 'keys'):
+            for key in other.keys():
+                self[key] = other[key]
+        else:
+            for key, value in other:
+                self[key] = value
+        for key, value in kwargs.items():
+            self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        while self:
+            self.popitem()
@@ -1,3 +1,5 @@
+import asyncio
+import functools
 import logging
 from typing import Callable
 
@@ -9,6 +11,8 @@ import tgpy.api
 from tgpy import reactions_fix
 from tgpy._core import message_design
 from tgpy._core.eval_message import eval_message, running_messages
+from tgpy._core.recent_messages import recent_messages
+from tgpy._handlers.dispatcher import dispatcher
 from tgpy.api.parse_code import parse_code
 from tgpy.api.transformers import exec_hooks
 from tgpy.api.utils import outgoing_messages_filter
@@ -16,6 +20,11 @@ from tgpy.reactions_fix import ReactionsFixResult
 
 logger = logging.getLogger(__name__)
 
+EDIT_DEBOUNCE_KEY = 'core.edits.debounce'
+EDIT_RESTART_KEY = 'core.edits.restart_running'
+# only the last of the edits made within this many seconds is evaluated
+DEFAULT_EDIT_DEBOUNCE = 0.5
+
 
 def _handle_errors(func: Callable):
     async def result(client, message: Message):
@@ -90,16 +99,27 @@ async def on_message_edited_handler(client, message: Message) -> None:
     if message.chat and message.chat.type == 'channel' and message.chat.is_broadcast:
         # Don't allow editing in channels, as there are complications with permission checks
         return
-    if (message.chat.id, message.id) in running_messages:
-        # Message is already running, editing should do nothing.
-        # The message will be corrected on the next flush or after evaluation finishes.
-        return
+    if task := running_messages.get((message.chat.id, message.id)):
+        if not tgpy.api.config.get(EDIT_RESTART_KEY):
+            # Message is already running, editing should do nothing.
+            # The message will be corrected on the next flush or after evaluation finishes.
+            message_design.forget_render(message)
+            return
+        if reactions_fix.check_hash(message) == ReactionsFixResult.ignore:
+            # the running code edited the message itself
+            return
+        # the code was changed, evaluate it again
+        task.cancel()
+        await asyncio.wait([task])
 
     reactions_fix_result = reactions_fix.check_hash(message)
 
     if reactions_fix_result == ReactionsFixResult.ignore:
         return
-    elif reactions_fix_result == ReactionsFixResult.show_warning:
+    # the user changed the message, so the last render is no longer there
+    message_design.forget_render(message)
+    recent_messages.discard(message)
+    if reactions_fix_result == ReactionsFixResult.show_warning:
         await handle_message(message, only_show_warning=True, client=client)
         return
     elif reactions_fix_result == ReactionsFixResult.evaluate:
@@ -110,12 +130,38 @@ async def on_message_edited_handler(client, message: Message) -> None:
     await handle_message(message, client=client)
 
 
+def _dispatched(func: Callable, debounce: bool = False):
+    # the update is handled in the background, so that Pyrogram's workers don't
+    # wait for evaluations to finish
+    async def result(client, message: Message):
+        key = (message.chat.id, message.id, func)
+        job = functools.partial(func, client, message)
+        if dispatcher.is_urgent(message):
+            dispatcher.submit(message.chat.id, key, job, urgent=True)
+            return
+        delay = None
+        if debounce:
+            delay = tgpy.api.config.get(EDIT_DEBOUNCE_KEY)
+            if delay is None:
+                delay = DEFAULT_EDIT_DEBOUNCE
+        if delay:
+            dispatcher.submit_later(message.chat.id, key, job, delay)
+        else:
+            dispatcher.submit(message.chat.id, key, job)
+
+    return result
+
+
 def add_handlers(client):
     client.add_handler(
-        MessageHandler(on_new_message_handler, filters.create(outgoing_messages_filter))
+        MessageHandler(
+            _dispatched(on_new_message_handler),
+            filters.create(outgoing_messages_filter),
+        )
     )
     client.add_handler(
         EditedMessageHandler(
-            on_message_edited_handler, filters.create(outgoing_messages_filter)
+            _dispatched(on_message_edited_handler, debounce=True),
+            filters.create(outgoing_messages_filter),
         )
     )
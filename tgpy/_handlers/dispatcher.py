@@ -0,0 +1,164 @@
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Hashable
+
+from pyrogram.types import Message
+
+import tgpy.api
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENCY_KEY = 'core.dispatch.max_concurrency'
+# how many updates are handled at once, not counting urgent ones
+DEFAULT_MAX_CONCURRENCY = 16
+
+Job = Callable[[], Awaitable[Any]]
+UrgentFilter = Callable[[Message], bool]
+
+
+@dataclass
+class _QueuedJob:
+    key: Hashable
+    job: Job
+    queued_at: float
+    context: contextvars.Context
+
+
+class Dispatcher:
+    """Runs update handlers with a limit on how many of them run at once.
+
+    Each chat has a FIFO queue, and chats take turns, so a burst of messages in
+    one chat doesn't delay the others. A job submitted with a key that is
+    already queued replaces the queued job and keeps its place, e.g. when a
+    message is edited twice before its evaluation starts. Urgent jobs, like
+    commands that cancel running code, start right away and don't count
+    towards the limit.
+
+    `submit_later` debounces jobs: the job is queued after a delay, and a newer
+    job with the same key restarts the delay and replaces the older one.
+    """
+
+    def __init__(self):
+        self._queues: dict[int, deque[_QueuedJob]] = {}
+        # chats with queued jobs, in the order they take turns
+        self._turns: deque[int] = deque()
+        self._queued: dict[Hashable, _QueuedJob] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._delayed: dict[Hashable, asyncio.TimerHandle] = {}
+        self.running = 0
+        self.urgent_filters: dict[str, UrgentFilter] = {}
+        self.submitted = 0
+        self.coalesced = 0
+        self.debounced = 0
+        self.urgent = 0
+        self.completed = 0
+        self.max_wait = 0.0
+        self._total_wait = 0.0
+        self._started = 0
+
+    @property
+    def max_concurrency(self) -> int:
+        return tgpy.api.config.get(MAX_CONCURRENCY_KEY) or DEFAULT_MAX_CONCURRENCY
+
+    def is_urgent(self, message: Message) -> bool:
+        for name, func in list(self.urgent_filters.items()):
+            try:
+                if func(message):
+                    return True
+            except Exception:
+                logger.exception(f'Urgent filter {name!r} failed')
+        return False
+
+    def submit(self, chat_id: int, key: Hashable, job: Job, urgent: bool = False):
+        """Queue `job()` to run after the earlier jobs of the chat have started"""
+        self.submitted += 1
+        if urgent:
+            self.urgent += 1
+            self._start(job, contextvars.copy_context(), counted=False)
+            return
+        if (queued := self._queued.get(key)) is not None:
+            self.coalesced += 1
+            queued.job = job
+            return
+        queued = _QueuedJob(key, job, time.monotonic(), contextvars.copy_context())
+        self._queued[key] = queued
+        if (queue := self._queues.get(chat_id)) is None:
+            queue = self._queues[chat_id] = deque()
+            self._turns.append(chat_id)
+        queue.append(queued)
+        self._pump()
+
+    def submit_later(self, chat_id: int, key: Hashable, job: Job, delay: float):
+        """Queue `job()` in `delay` seconds unless another job with the same key
+        is submitted meanwhile"""
+        if (handle := self._delayed.pop(key, None)) is not None:
+            handle.cancel()
+            self.debounced += 1
+        self._delayed[key] = asyncio.get_running_loop().call_later(
+            delay, self._submit_delayed, chat_id, key, job
+        )
+
+    def _submit_delayed(self, chat_id: int, key: Hashable, job: Job):
+        del self._delayed[key]
+        self.submit(chat_id, key, job)
+
+    def _pump(self):
+        while self._turns and self.running < self.max_concurrency:
+            chat_id = self._turns.popleft()
+            queue = self._queues[chat_id]
+            queued = queue.popleft()
+            if queue:
+                self._turns.append(chat_id)
+            else:
+                del self._queues[chat_id]
+            del self._queued[queued.key]
+            wait = time.monotonic() - queued.queued_at
+            self._started += 1
+            self._total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self._start(queued.job, queued.context, counted=True)
+
+    def _start(self, job: Job, context: contextvars.Context, counted: bool):
+        if counted:
+            self.running += 1
+        task = asyncio.create_task(self._run(job, counted), context=context)
+        # keep a reference until the task finishes
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job: Job, counted: bool):
+        try:
+            await job()
+        except Exception:
+            logger.exception('Update handler failed')
+        finally:
+            self.completed += 1
+            if counted:
+                self.running -= 1
+                self._pump()
+
+    @property
+    def metrics(self) -> dict[str, Any]:
+        """Queue depth, counters and how long jobs wait before they start"""
+        return {
+            'delayed': len(self._delayed),
+            'queued': len(self._queued),
+            'queued_by_chat': {k: len(v) for k, v in self._queues.items()},
+            'running': self.running,
+            'submitted': self.submitted,
+            'coalesced': self.coalesced,
+            'debounced': self.debounced,
+            'urgent': self.urgent,
+            'completed': self.completed,
+            'avg_wait': self._total_wait / self._started if self._started else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+
+dispatcher = Dispatcher()
+
+__all__ = ['Dispatcher', 'dispatcher']
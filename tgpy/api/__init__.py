@@ -15,6 +15,7 @@ from .utils import (
     try_await,
     untokenize_to_string,
 )
+from .watchdog import watchdog
 
 __all__ = [
     # config
@@ -46,4 +47,6 @@ __all__ = [
     'try_await',
     'tokenize_string',
     'untokenize_to_string',
+    # watchdog
+    'watchdog',
 ]
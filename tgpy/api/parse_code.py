@@ -1,12 +1,22 @@
 import ast
 import logging
-from dataclasses import dataclass
+import pickle
+from copy import deepcopy
+from dataclasses import dataclass, fields
+from typing import Container
 
 import tgpy.api
+from tgpy._core.fused_walk import AstFacts
+from tgpy._core.prefilter import definitely_not_code
+from tgpy._core.source_registry import cache_max_bytes
+from tgpy._core.utils import LRUCache
 from tgpy.api.transformers import ast_transformers, code_transformers
 
 logger = logging.getLogger(__name__)
 
+# names which are available in the code, but are not saved in variables or constants
+_EXTRA_NAMES = ('msg', 'print', 'orig')
+
 
 @dataclass
 class ParseResult:
@@ -16,16 +26,93 @@ class ParseResult:
     transformed: str = ''
     tree: ast.AST | None = None
     exc: Exception | None = None
+    facts: AstFacts | None = None
+
+
+def _copy_tree(tree: ast.AST) -> ast.AST:
+    try:
+        return pickle.loads(pickle.dumps(tree, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        # transformers may attach unpicklable objects to nodes
+        return deepcopy(tree)
+
+
+class _CachedParseResult(ParseResult):
+    """ParseResult which shares the tree with the cache entry.
+    The tree is copied on first access, so the caller is free to modify it
+    """
+
+    def __init__(self, entry: ParseResult):
+        super().__init__(**{f.name: getattr(entry, f.name) for f in fields(entry)})
+        self._tree_is_shared = True
+
+    @property
+    def tree(self) -> ast.AST | None:
+        if self._tree_is_shared:
+            self._tree = _copy_tree(self._tree)
+            self._tree_is_shared = False
+        return self._tree
 
+    @tree.setter
+    def tree(self, value: ast.AST | None):
+        self._tree = value
+        self._tree_is_shared = False
+
+
+@dataclass
+class _CacheEntry:
+    result: ParseResult
+    transformers_versions: tuple[int, int]
+    # names of the tree which were defined when the decision was made
+    known_names: frozenset[str] | None
+    names_versions: tuple[int, int]
+
+
+# (text, ignore_simple) -> _CacheEntry
+parse_cache = LRUCache(512, cache_max_bytes)
+# approximate memory held by a syntax tree per byte of its source
+TREE_BYTES_PER_SOURCE_BYTE = 32
+
+
+def _entry_size(result: ParseResult) -> int:
+    size = len(result.original.encode('utf-8'))
+    if result.tree is None:
+        return size
+    return size * (1 + TREE_BYTES_PER_SOURCE_BYTE) + len(
+        result.transformed.encode('utf-8')
+    )
+
+
+class _KnownNames:
+    """Names defined in variables, constants or passed to the code"""
+
+    def __contains__(self, name: str) -> bool:
+        return (
+            name in tgpy.api.variables
+            or name in tgpy.api.constants
+            or name in _EXTRA_NAMES
+        )
 
-def _is_node_unknown_variable(node: ast.AST, locs: dict) -> bool:
+
+_known = _KnownNames()
+
+
+def _names_versions() -> tuple[int, int]:
+    return tgpy.api.variables.names_version, tgpy.api.constants.names_version
+
+
+def _known_names(facts: AstFacts) -> frozenset[str]:
+    return frozenset(name for name in facts.names if name in _known)
+
+
+def _is_node_unknown_variable(node: ast.AST, locs: Container[str]) -> bool:
     """Check if AST node is a Name or Attribute not present in locals"""
     if isinstance(node, ast.Attribute):
         return _is_node_unknown_variable(node.value, locs)
     return isinstance(node, ast.Name) and node.id not in locs
 
 
-def _is_node_suspicious_binop(node: ast.AST, locs: dict) -> bool:
+def _is_node_suspicious_binop(node: ast.AST, locs: Container[str]) -> bool:
     """Check if AST node can be an operand of binary operation (ast.BinOp, ast.Compare, ast.BoolOp)
     with operands which do not pass _is_node_unknown_variable check, or is such operation
     """
@@ -45,7 +132,7 @@ def _is_node_suspicious_binop(node: ast.AST, locs: dict) -> bool:
     )
 
 
-def _ignore_node_simple(node: ast.AST, locs: dict) -> bool:
+def _ignore_node_simple(node: ast.AST, locs: Container[str]) -> bool:
     """Check if message is constant or unknown variable"""
     return (
         # Messages like "python", "123" or "example.com"
@@ -53,7 +140,7 @@ def _ignore_node_simple(node: ast.AST, locs: dict) -> bool:
     )
 
 
-def _ignore_node(node: ast.AST, locs: dict) -> bool:
+def _ignore_node(node: ast.AST, locs: Container[str]) -> bool:
     """Check if AST node didn't seem to be meant to be code"""
     if isinstance(node, ast.Expr):
         return _ignore_node(node.value, locs)
@@ -86,36 +173,55 @@ def _ignore_node(node: ast.AST, locs: dict) -> bool:
 
 async def parse_code(text: str, ignore_simple: bool = True) -> ParseResult:
     """Parse given text and decide should it be evaluated as Python code"""
+    key = (text, ignore_simple)
+    versions = (code_transformers.version, ast_transformers.version)
+    names_versions = _names_versions()
+    entry: _CacheEntry | None = parse_cache.get(key)
+    if entry and entry.transformers_versions == versions:
+        if entry.known_names is None or entry.names_versions == names_versions:
+            return _CachedParseResult(entry.result)
+        if _known_names(entry.result.facts) == entry.known_names:
+            entry.names_versions = names_versions
+            return _CachedParseResult(entry.result)
+
+    result = await _parse_code(text, ignore_simple)
+    known_names = None
+    if ignore_simple and result.facts:
+        # the decision depends on which names of the tree are defined
+        known_names = _known_names(result.facts)
+    parse_cache.put(
+        key,
+        _CacheEntry(result, versions, known_names, names_versions),
+        _entry_size(result),
+    )
+    return _CachedParseResult(result)
+
+
+async def _parse_code(text: str, ignore_simple: bool) -> ParseResult:
     result = ParseResult(original=text)
 
     text = await code_transformers.apply(text)
     result.transformed = text
 
+    if ignore_simple and definitely_not_code(text):
+        # most messages are plain text, don't parse them
+        return result
+
     try:
         tree = ast.parse(text, '', 'exec')
     except (SyntaxError, ValueError) as e:
         result.exc = e
         return result
 
-    tree = await ast_transformers.apply(tree)
+    tree, facts = await ast_transformers.apply_with_facts(tree)
     result.tree = tree
+    result.facts = facts
 
-    if ignore_simple:
-        locs = (
-            list(tgpy.api.variables.keys())
-            + list(tgpy.api.constants.keys())
-            + ['msg', 'print', 'orig']
-        )
-        if all(_ignore_node(body_item, locs) for body_item in tree.body):
-            return result
+    if ignore_simple and all(_ignore_node(item, _known) for item in tree.body):
+        return result
 
     result.is_code = True
-
-    for node in ast.walk(tree):
-        if isinstance(node, ast.Name) and node.id == 'orig':
-            result.uses_orig = True
-            return result
-
+    result.uses_orig = facts.uses_orig
     return result
 
 
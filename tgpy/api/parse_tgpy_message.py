@@ -2,10 +2,7 @@ from dataclasses import dataclass
 
 from pyrogram.types import Message
 
-from tgpy._core.message_design import (
-    Utf16CodepointsWrapper,
-    get_united_code_entity,
-)
+from tgpy._core.message_design import Utf16Index, get_united_code_entity
 
 
 @dataclass
@@ -25,9 +22,9 @@ def parse_tgpy_message(message: Message) -> MessageParseResult:
         msg_text_str = message.caption
     else:
         msg_text_str = ''
-    msg_text = Utf16CodepointsWrapper(msg_text_str)
-    code = msg_text[e.offset : e.length].strip()
-    result = msg_text[msg_text.find('>', e.offset + e.length) + 1 :].strip()
+    msg_text = Utf16Index(msg_text_str)
+    code = msg_text.slice(e.offset, e.length).strip()
+    result = msg_text.slice(msg_text.find('>', e.offset + e.length) + 1).strip()
     return MessageParseResult(True, code, result)
 
 
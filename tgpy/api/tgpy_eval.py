@@ -1,4 +1,6 @@
 import asyncio
+import contextvars
+import logging
 from dataclasses import dataclass
 from typing import Any
 
@@ -6,13 +8,48 @@ from pyrogram.types import Message
 
 import tgpy.api
 from tgpy import app
-from tgpy._core import message_design
+from tgpy._core import backends, message_design
+from tgpy._core.edit_scheduler import edit_scheduler
+from tgpy._core.limits import LimitGuard, get_limits
 from tgpy._core.meval import _meval
+from tgpy._core.utils import ObservableDict
 from tgpy.api.parse_code import parse_code
+from tgpy.api.watchdog import watchdog
 from tgpy.utils import FILENAME_PREFIX, numid
 
-variables: dict[str, Any] = {}
-constants: dict[str, Any] = {}
+logger = logging.getLogger(__name__)
+
+variables: ObservableDict = ObservableDict()
+constants: ObservableDict = ObservableDict()
+
+EVAL_MODE_KEY = 'core.eval.mode'
+# seconds between edits with the output of running code
+FLUSH_DELAY = 3
+# persistent globals of code evaluated in the "namespace" mode,
+# kept in sync with variables and constants (variables take precedence)
+_namespace: dict[str, Any] = {}
+
+
+def _sync_variable(name: str, value: Any, deleted: bool):
+    if not deleted:
+        _namespace[name] = value
+    elif name in constants:
+        _namespace[name] = constants[name]
+    else:
+        _namespace.pop(name, None)
+
+
+def _sync_constant(name: str, value: Any, deleted: bool):
+    if name in variables:
+        return
+    if deleted:
+        _namespace.pop(name, None)
+    else:
+        _namespace[name] = value
+
+
+variables.add_observer(_sync_variable)
+constants.add_observer(_sync_constant)
 
 
 @dataclass
@@ -22,46 +59,98 @@ class EvalResult:
 
 
 class Flusher:
+    """Shows the output of running code in its message.
+
+    Flushes don't read the output: they only schedule an edit, which reads the
+    latest output when it's sent. Output written without a flush is also shown:
+    every `FLUSH_DELAY` seconds the flusher checks for new output and makes the
+    next write flush it.
+    """
+
     _code: str
     _message: Message | None
-    _flushed_output: str
-    _flush_timer: asyncio.Task | None
+    _scheduled: asyncio.Future | None
     _finished: bool
+    _loop: asyncio.AbstractEventLoop
+    # copy of the context of the code, to access its output
+    _context: contextvars.Context | None
+    # number of characters written when the output was last shown
+    _shown_size: int
+    _poll_handle: asyncio.TimerHandle | None
 
     def __init__(self, code: str, message: Message | None):
         self._code = code
         self._message = message
-        self._flushed_output = ''
-        self._flush_timer = None
+        self._loop = asyncio.get_running_loop()
+        self._scheduled = None
         self._finished = False
+        self._context = None
+        self._shown_size = 0
+        self._poll_handle = None
 
-    async def _wait_and_flush(self):
-        await asyncio.sleep(3)
-        if self._message:
-            await message_design.edit_message(
-                self._message,
-                self._code,
-                output=self._flushed_output,
-                is_running=True,
-            )
-        self._flush_timer = None
+    def start(self):
+        """Start watching the output. Called in the context of the code"""
+        if not self._message:
+            return
+        self._context = contextvars.copy_context()
+        self._poll_handle = self._loop.call_later(FLUSH_DELAY, self._poll)
+
+    def _written(self) -> int:
+        # noinspection PyProtectedMember
+        return self._context.run(lambda: app.ctx._output_written)
+
+    def _poll(self):
+        if self._finished:
+            return
+        if self._written() != self._shown_size:
+            # the handler must run in the context of the code itself
+            # noinspection PyProtectedMember
+            self._context.run(lambda: app.ctx._request_flush())
+        self._poll_handle = self._loop.call_later(FLUSH_DELAY, self._poll)
+
+    async def _render(self):
+        self._scheduled = None
+        self._shown_size = self._written()
+        # noinspection PyProtectedMember
+        output = self._context.run(lambda: app.ctx._output)
+        return await message_design.render_message(
+            self._message,
+            self._code,
+            output=output,
+            is_running=True,
+        )
 
     def flush_handler(self):
         if not self._message or self._finished or app.ctx.is_manual_output:
             return
+        if self._scheduled and not self._scheduled.done():
+            # the scheduled edit will show the latest output
+            return
         # noinspection PyProtectedMember
-        self._flushed_output = app.ctx._output
-        if self._flush_timer:
-            # flush already scheduled, will print the latest output
+        if asyncio._get_running_loop() is not self._loop:
+            # code runs in another thread
+            self._loop.call_soon_threadsafe(
+                self.flush_handler, context=contextvars.copy_context()
+            )
             return
-        self._flush_timer = asyncio.create_task(self._wait_and_flush())
+        self._scheduled = edit_scheduler.submit(
+            self._message, self._render, delay=FLUSH_DELAY
+        )
+        self._scheduled.add_done_callback(_ignore_result)
 
     def set_finished(self):
-        if self._flush_timer:
-            self._flush_timer.cancel()
+        if self._scheduled:
+            edit_scheduler.cancel(self._message)
+        if self._poll_handle is not None:
+            self._poll_handle.cancel()
         self._finished = True
 
 
+def _ignore_result(future: asyncio.Future):
+    if not future.cancelled() and (exc := future.exception()) is not None:
+        logger.debug(f'Failed to flush the output: {exc!r}')
+
+
 async def tgpy_eval(
     code: str,
     message: Message | None = None,
@@ -80,8 +169,14 @@ async def tgpy_eval(
 
     flusher = Flusher(code, message)
 
+    limits = get_limits(code)
     # noinspection PyProtectedMember
-    app.ctx._init_stdio(flusher.flush_handler)
+    app.ctx._init_stdio(
+        flusher.flush_handler,
+        max_size=limits.output,
+        kill_on_limit=limits.kill_on_output_limit,
+    )
+    flusher.start()
     kwargs = {'msg': message}
     if message:
         # noinspection PyProtectedMember
@@ -98,16 +193,43 @@ async def tgpy_eval(
         else:
             kwargs['orig'] = None
 
+    backend = backends.get_backend(code)
+    use_namespace = tgpy.api.config.get(EVAL_MODE_KEY) == 'namespace'
     try:
-        new_variables, result = await _meval(
-            parsed,
-            filename,
-            tgpy.api.variables,
-            **tgpy.api.constants,
-            **kwargs,
-        )
+        with LimitGuard(limits):
+            if backend == backends.PROCESS:
+                new_variables, result = await backends.run_in_process(
+                    parsed, filename, kwargs
+                )
+            else:
+                executor = None
+                if backend == backends.THREAD:
+                    executor = backends.get_thread_pool()
+                if use_namespace:
+                    new_variables, result = await _meval(
+                        parsed,
+                        filename,
+                        tgpy.api.variables,
+                        namespace=_namespace,
+                        executor=executor,
+                        **kwargs,
+                    )
+                else:
+                    new_variables, result = await _meval(
+                        parsed,
+                        filename,
+                        tgpy.api.variables,
+                        executor=executor,
+                        **tgpy.api.constants,
+                        **kwargs,
+                    )
     finally:
         flusher.set_finished()
+        # the output may be full already, and an exception here would replace
+        # the one raised by the code
+        for stall in watchdog.pop_reports(filename):
+            # noinspection PyProtectedMember
+            app.ctx._report(stall.format())
     if '__all__' in new_variables:
         new_variables = {
             k: v for k, v in new_variables.items() if k in new_variables['__all__']
@@ -4,6 +4,7 @@ from typing import Awaitable, Callable, Generic, Iterator, Literal, Type, TypeVa
 
 from pyrogram.types import Message
 
+from tgpy._core.fused_walk import AstFacts, collect_facts, fused_walk
 from tgpy.api.utils import try_await
 
 logger = logging.getLogger(__name__)
@@ -29,6 +30,12 @@ class _TransformerStore(Generic[TF]):
     def __init__(self):
         self._by_name = {}
         self._names = []
+        self._version = 0
+
+    @property
+    def version(self) -> int:
+        """Incremented on every change of the store, usable as a cache key"""
+        return self._version
 
     def __iter__(self) -> Iterator[tuple[str, TF]]:
         for name in self._names:
@@ -54,10 +61,12 @@ class _TransformerStore(Generic[TF]):
             self._names[key] = value[0]
             del self._by_name[old_name]
             self._by_name[value[0]] = value[1]
+            self._version += 1
         elif isinstance(key, str) and callable(value):
             if key not in self._by_name:
                 self._names.append(key)
             self._by_name[key] = value
+            self._version += 1
         else:
             raise TypeError(
                 'only `obj[str] = func` and `obj[int] = (str, func)` syntaxes are supported'
@@ -66,6 +75,7 @@ class _TransformerStore(Generic[TF]):
     def add(self, name: str, func: TF):
         self._names.append(name)
         self._by_name[name] = func
+        self._version += 1
 
     def append(self, val: tuple[str, TF]):
         return self.add(*val)
@@ -79,6 +89,7 @@ class _TransformerStore(Generic[TF]):
             del self._names[key]
         else:
             raise TypeError(f'Expected str or int, got {type(key)}')
+        self._version += 1
 
     def __delitem__(self, key: str | int):
         self.remove(key)
@@ -98,13 +109,47 @@ class CodeTransformerStore(_TransformerStore[CodeTransformerFunc]):
         return code
 
 
+class FusedTransformer:
+    """Base class for AST transformers which are applied in a single tree traversal
+    together with other fused transformers.
+
+    Define `visit_<NodeType>` methods like in ast.NodeTransformer. They are called
+    after the children of the node are already transformed, so they must not call
+    generic_visit. A method returns the new node, a list of nodes or None to remove
+    the node. Nodes returned by a method are not traversed again.
+    """
+
+
 class AstTransformerStore(
-    _TransformerStore[AstTransformerFunc | Type[ast.NodeTransformer]]
+    _TransformerStore[
+        AstTransformerFunc | Type[ast.NodeTransformer] | Type[FusedTransformer]
+    ]
 ):
     async def apply(self, tree: ast.AST) -> ast.AST:
+        tree, _ = await self.apply_with_facts(tree)
+        return tree
+
+    async def apply_with_facts(self, tree: ast.AST) -> tuple[ast.AST, AstFacts]:
+        """Apply transformers and collect facts about the resulting tree.
+        Consecutive fused transformers share one traversal, which also collects the facts
+        if they are applied last.
+        """
+        facts = None
+        fused = []
         for _, transformer in reversed(self):
+            is_fused = isinstance(transformer, type) and issubclass(
+                transformer, FusedTransformer
+            )
+            if is_fused:
+                fused.append(transformer)
+                continue
+            if fused:
+                tree, _ = self._apply_fused(tree, fused)
+                fused = []
             try:
-                if issubclass(transformer, ast.NodeTransformer):
+                if isinstance(transformer, type) and issubclass(
+                    transformer, ast.NodeTransformer
+                ):
                     tree = transformer().visit(tree)
                 else:
                     tree = await try_await(transformer, tree)
@@ -114,7 +159,24 @@ class AstTransformerStore(
                     exc_info=True,
                 )
                 raise
-        return tree
+        if fused:
+            tree, facts = self._apply_fused(tree, fused)
+        if facts is None:
+            facts = collect_facts(tree)
+        return tree, facts
+
+    @staticmethod
+    def _apply_fused(
+        tree: ast.AST, transformers: list[Type[FusedTransformer]]
+    ) -> tuple[ast.AST, AstFacts]:
+        try:
+            return fused_walk(tree, [transformer() for transformer in transformers])
+        except Exception:
+            logger.exception(
+                f'Error while applying AST transformers {transformers}',
+                exc_info=True,
+            )
+            raise
 
 
 class ExecHookStore(_TransformerStore[ExecHookFunc]):
@@ -147,6 +209,7 @@ exec_hooks = ExecHookStore()
 __all__ = [
     'CodeTransformerFunc',
     'AstTransformerFunc',
+    'FusedTransformer',
     'ExecHookFunc',
     'code_transformers',
     'ast_transformers',
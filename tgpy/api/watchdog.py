@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from types import FrameType
+
+import tgpy.api
+from tgpy.utils import FILENAME_PREFIX
+
+logger = logging.getLogger(__name__)
+
+ENABLED_KEY = 'core.watchdog.enabled'
+THRESHOLD_KEY = 'core.watchdog.threshold'
+REPORT_KEY = 'core.watchdog.report'
+DEFAULT_THRESHOLD = 1.0
+# how often the loop sends heartbeats and the watchdog checks them, in seconds
+INTERVAL = 0.1
+HISTORY_SIZE = 100
+
+
+@dataclass
+class LoopStall:
+    """A period when the event loop was blocked for longer than the threshold"""
+
+    # unix time when the loop was last seen responsive
+    started_at: float
+    # how long the loop was blocked, None while it is still blocked
+    duration: float | None = None
+    # innermost tgpy:// frame which was running most often
+    filename: str | None = None
+    lineno: int | None = None
+    # stack of the loop thread when the stall was detected
+    stack: list[str] = field(default_factory=list)
+    samples: Counter[tuple[str, int]] = field(default_factory=Counter)
+
+    def format(self) -> str:
+        location = (
+            f'{self.filename}, line {self.lineno}' if self.filename else 'unknown'
+        )
+        duration = f'{self.duration:.1f} s' if self.duration is not None else 'now'
+        return f'Event loop was blocked for {duration} at {location}'
+
+
+def _find_tgpy_frame(frame: FrameType | None) -> FrameType | None:
+    while frame is not None:
+        if frame.f_code.co_filename.startswith(FILENAME_PREFIX):
+            return frame
+        frame = frame.f_back
+    return None
+
+
+class LoopWatchdog:
+    """Measures event loop lag from a separate thread and samples the stack
+    of the loop thread when the loop is blocked
+    """
+
+    def __init__(self):
+        self.stalls: deque[LoopStall] = deque(maxlen=HISTORY_SIZE)
+        self._lock = threading.Lock()
+        self._current: LoopStall | None = None
+        # stalls not yet shown in the output of the code that caused them
+        self._reports: dict[str, list[LoopStall]] = {}
+        self._last_beat = time.monotonic()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread_id: int | None = None
+        self._thread: threading.Thread | None = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self):
+        """Start watching the running event loop, unless disabled in the config"""
+        if self.running or tgpy.api.config.get(ENABLED_KEY) is False:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._loop.call_later(INTERVAL, self._beat)
+        self._thread = threading.Thread(
+            target=self._watch, name='tgpy-watchdog', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _beat(self):
+        now = time.monotonic()
+        with self._lock:
+            stall = self._current
+            if stall is not None:
+                stall.duration = now - self._last_beat - INTERVAL
+                self._current = None
+            self._last_beat = now
+        if not self._stop.is_set():
+            self._loop.call_later(INTERVAL, self._beat)
+
+    def _watch(self):
+        while not self._stop.wait(INTERVAL):
+            threshold = tgpy.api.config.get(THRESHOLD_KEY) or DEFAULT_THRESHOLD
+            with self._lock:
+                lag = time.monotonic() - self._last_beat
+                if lag < threshold:
+                    continue
+                # noinspection PyProtectedMember
+                frame = sys._current_frames().get(self._loop_thread_id)
+                self._sample(frame)
+
+    def _sample(self, frame: FrameType | None):
+        stall = self._current
+        if stall is None:
+            stall = LoopStall(
+                started_at=time.time() - (time.monotonic() - self._last_beat),
+                stack=traceback.format_stack(frame) if frame else [],
+            )
+            self._current = stall
+            self.stalls.append(stall)
+            logger.warning('Event loop is blocked')
+        tgpy_frame = _find_tgpy_frame(frame)
+        if tgpy_frame is None:
+            return
+        stall.samples[tgpy_frame.f_code.co_filename, tgpy_frame.f_lineno] += 1
+        (stall.filename, stall.lineno), _ = stall.samples.most_common(1)[0]
+        if stall.samples.total() == 1 and tgpy.api.config.get(REPORT_KEY):
+            reports = self._reports.setdefault(stall.filename, [])
+            reports.append(stall)
+            while len(self._reports) > HISTORY_SIZE:
+                del self._reports[next(iter(self._reports))]
+
+    def pop_reports(self, filename: str) -> list[LoopStall]:
+        """Take the stalls caused by the code with the given filename.
+        Must be called from the loop thread, as the current stall is considered finished
+        """
+        with self._lock:
+            reports = self._reports.pop(filename, [])
+            if self._current in reports:
+                self._current.duration = time.monotonic() - self._last_beat
+            return reports
+
+
+watchdog = LoopWatchdog()
+
+__all__ = ['LoopStall', 'LoopWatchdog', 'watchdog']
@@ -1,14 +1,18 @@
+import mmap
 import sys
+import tempfile
+import threading
+from collections import deque
 from contextvars import ContextVar
-from io import StringIO, TextIOBase
-from typing import Callable
+from io import TextIOBase
+from typing import BinaryIO, Callable
 
 from pyrogram.types import Message
 
 _is_module: ContextVar[bool] = ContextVar('_is_module')
 _message: ContextVar[Message] = ContextVar('_message')
-_stdout: ContextVar[StringIO] = ContextVar('_stdout')
-_stderr: ContextVar[StringIO] = ContextVar('_stderr')
+_stdout: ContextVar['OutputBuffer'] = ContextVar('_stdout')
+_stderr: ContextVar['OutputBuffer'] = ContextVar('_stderr')
 _flush_handler: ContextVar[Callable[[], None]] = ContextVar('_flush_handler')
 _is_manual_output: ContextVar[bool] = ContextVar('_is_manual_output', default=False)
 
@@ -22,7 +26,7 @@ class _StdoutWrapper(TextIOBase):
         return self.__contextvar.get(self.__fallback)
 
     def write(self, s: str) -> int:
-        return self.__getobj().write(s)
+        return self.__contextvar.get(self.__fallback).write(s)
 
     def flush(self) -> None:
         self.__getobj().flush()
@@ -43,6 +47,250 @@ def cleanup_erases(data: str):
     return '\n'.join(x.rsplit('\r', 1)[-1] for x in lines)
 
 
+# how many characters of each output stream are kept in memory,
+# a message can only show 4096
+OUTPUT_LIMIT = 16384
+# how many characters a single evaluation may write to each stream
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+
+class ResourceLimitExceeded(Exception):
+    """The code ran out of time, memory or output size"""
+
+
+class OutputLimitExceeded(ResourceLimitExceeded):
+    pass
+
+
+class OutputBuffer(TextIOBase):
+    """Terminal-like text buffer which applies `\\r` and `\\n` as data arrives.
+
+    `getvalue()` returns the same text as `cleanup_erases` applied to everything
+    written, but only the last `limit` characters of it are kept in memory. When
+    the output gets longer, completed lines are also written to a temporary file,
+    and `read_full()` returns the whole output.
+
+    After `max_size` characters are written, the rest is dropped, or the write
+    raises `OutputLimitExceeded` if `kill_on_limit` is set.
+
+    Writes are only appended to a list and processed in batches, when enough text
+    is collected or the output is read. The code may write from other threads
+    while the output is read, so the processing is done under a lock. A write
+    which doesn't complete a batch, reach `max_size` or have to notify only
+    compares the new size with `_check_at`.
+
+    Setting `notify_due` makes the next write call `notify`.
+    """
+
+    def __init__(
+        self,
+        limit: int = OUTPUT_LIMIT,
+        max_size: int | None = None,
+        kill_on_limit: bool = False,
+        notify: Callable[[], None] | None = None,
+    ):
+        self.limit = limit
+        self.max_size = max_size
+        self.kill_on_limit = kill_on_limit
+        # number of characters written, before \r and \n are applied
+        self.written = 0
+        self._lines: deque[str] = deque()
+        self._lines_size = 0
+        # parts of the current line after its last \r
+        self._line: list[str] = []
+        self._line_size = 0
+        # the last write ended with \r, which may be the start of \r\n
+        self._pending_cr = False
+        self._file: BinaryIO | None = None
+        # written text which isn't processed yet
+        self._pending: list[str] = []
+        # `written` when the pending text was last processed
+        self._batch_start = 0
+        self._lock = threading.Lock()
+        self.notify = notify
+        self._notify_due = False
+        # writes which make `written` larger than this take the slow path
+        self._check_at = 0
+        self._update_check_at()
+
+    @property
+    def notify_due(self) -> bool:
+        return self._notify_due
+
+    @notify_due.setter
+    def notify_due(self, value: bool):
+        self._notify_due = value
+        self._update_check_at()
+
+    def _update_check_at(self):
+        if self._notify_due:
+            self._check_at = -1
+            return
+        check_at = self._batch_start + self.limit
+        if self.max_size is not None:
+            check_at = min(check_at, self.max_size)
+        self._check_at = check_at
+
+    def writable(self) -> bool:
+        return True
+
+    @property
+    def spilled(self) -> bool:
+        with self._lock:
+            self._process_pending()
+            return self._file is not None
+
+    def write(self, s: str) -> int:
+        written = self.written + len(s)
+        if written <= self._check_at:
+            self.written = written
+            self._pending.append(s)
+            return len(s)
+        return self._write_slow(s)
+
+    def _write_slow(self, s: str) -> int:
+        length = len(s)
+        if self.max_size is not None and self.written + length > self.max_size:
+            if self.kill_on_limit:
+                raise OutputLimitExceeded(
+                    f'Output is longer than {self.max_size} characters'
+                )
+            s = s[: self.max_size - self.written]
+        self.written += len(s)
+        self._pending.append(s)
+        if self.written - self._batch_start > self.limit:
+            with self._lock:
+                self._process_pending()
+        notify = self._notify_due and self.notify
+        self._notify_due = False
+        self._update_check_at()
+        if notify:
+            notify()
+        return length
+
+    def append(self, s: str):
+        """Add text from TGPy itself, like a report about the code. It doesn't
+        count as written by the code, so `max_size` doesn't apply to it"""
+        with self._lock:
+            self._pending.append(s)
+            self._process_pending()
+
+    def _process_pending(self):
+        # appends from other threads may happen meanwhile, they stay in the list
+        count = len(self._pending)
+        if not count:
+            return
+        s = ''.join(self._pending[:count])
+        del self._pending[:count]
+        self._batch_start = self.written
+        self._update_check_at()
+        self._process(s)
+
+    def _process(self, s: str):
+        if self._pending_cr:
+            s = '\r' + s
+            self._pending_cr = False
+        if '\r' in s:
+            if s[-1] == '\r':
+                s = s[:-1]
+                self._pending_cr = True
+            s = s.replace('\r\n', '\n')
+        if '\n' in s:
+            lines = s.split('\n')
+            s = lines.pop()
+            self._end_lines(lines)
+        if '\r' in s:
+            s = s.rsplit('\r', 1)[-1]
+            self._line.clear()
+            self._line_size = 0
+        if s:
+            self._line.append(s)
+            self._line_size += len(s)
+        # trimmed in batches, getvalue() cuts the rest
+        if self._lines_size + self._line_size > 2 * self.limit:
+            self._trim()
+
+    def _end_lines(self, lines: list[str]):
+        first = lines[0]
+        if '\r' in first:
+            # text of a long line that is already spilled can't be erased
+            # from the file, only from the memory
+            lines[0] = first.rsplit('\r', 1)[-1]
+        elif self._line:
+            lines[0] = ''.join(self._line) + first
+        self._line.clear()
+        self._line_size = 0
+        for i in range(1, len(lines)):
+            if '\r' in lines[i]:
+                lines[i] = lines[i].rsplit('\r', 1)[-1]
+        self._lines.extend(lines)
+        # newline characters are counted as a part of the line
+        self._lines_size += sum(map(len, lines)) + len(lines)
+        if self._file is not None:
+            self._spill('\n'.join(lines) + '\n')
+
+    def _spill(self, s: str):
+        self._file.write(s.encode('utf-8', 'surrogatepass'))
+
+    def _trim(self):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix='tgpy-output-')
+            if self._lines:
+                self._spill('\n'.join(self._lines) + '\n')
+        # keep enough lines to fill the limit even if the current line is erased
+        while self._lines and self._lines_size - len(self._lines[0]) > self.limit:
+            self._lines_size -= len(self._lines.popleft()) + 1
+        if self._line_size > 2 * self.limit:
+            line = ''.join(self._line)
+            # the beginning of the line goes to the file right away
+            self._spill(line[: -self.limit])
+            self._line = [line[-self.limit :]]
+            self._line_size = self.limit
+
+    def _current_line(self) -> str:
+        return '' if self._pending_cr else ''.join(self._line)
+
+    def getvalue(self) -> str:
+        with self._lock:
+            self._process_pending()
+            line = self._current_line()
+            if self._lines:
+                line = '\n'.join(self._lines) + '\n' + line
+        return line[-self.limit :]
+
+    def read_full(self) -> str:
+        """The whole output, including the part that isn't kept in memory"""
+        with self._lock:
+            self._process_pending()
+            return self._read_full()
+
+    def _read_full(self) -> str:
+        line = self._current_line()
+        if self._file is None:
+            return ''.join(line + '\n' for line in self._lines) + line
+        self._file.flush()
+        if not self._file.tell():
+            return line
+        with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return str(data, 'utf-8', 'surrogatepass') + line
+
+    def segments(self) -> list['bytes | tuple[BinaryIO, int]']:
+        """The whole output encoded as UTF-8, as pieces of memory and
+        `(file, size)` ranges of the spill file, without reading the file"""
+        with self._lock:
+            self._process_pending()
+            if self._file is None:
+                return [self._read_full().encode('utf-8', 'surrogatepass')]
+            line = self._current_line().encode('utf-8', 'surrogatepass')
+            self._file.flush()
+            return [(self._file, self._file.tell()), line]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        super().close()
+
+
 class Context:
     @property
     def is_module(self) -> bool:
@@ -65,19 +313,64 @@ class Context:
         # The ContextVar already has a default of None via _message.get(None)
 
     @staticmethod
-    def _init_stdio(flush_handler: Callable[[], None]):
-        _stdout.set(StringIO())
-        _stderr.set(StringIO())
+    def _init_stdio(
+        flush_handler: Callable[[], None],
+        max_size: int | None = DEFAULT_MAX_SIZE,
+        kill_on_limit: bool = True,
+    ):
+        for var in (_stdout, _stderr):
+            var.set(
+                OutputBuffer(
+                    max_size=max_size, kill_on_limit=kill_on_limit, notify=flush_handler
+                )
+            )
         _flush_handler.set(flush_handler)
 
+    @staticmethod
+    def _report(text: str):
+        """Add a line from TGPy to stderr, even if the output limit is reached"""
+        _stderr.get().append(text + '\n')
+
+    @staticmethod
+    def _request_flush():
+        """Call the flush handler on the next write to stdout or stderr"""
+        _stdout.get().notify_due = True
+        _stderr.get().notify_due = True
+
     @property
     def _output(self) -> str:
-        stderr = cleanup_erases(_stderr.get().getvalue())
-        stdout = cleanup_erases(_stdout.get().getvalue())
+        stderr = _stderr.get().getvalue()
+        stdout = _stdout.get().getvalue()
+        if stderr and stderr[-1] != '\n':
+            stderr += '\n'
+        return stderr + stdout
+
+    @property
+    def _full_output(self) -> str:
+        stderr = _stderr.get().read_full()
+        stdout = _stdout.get().read_full()
         if stderr and stderr[-1] != '\n':
             stderr += '\n'
         return stderr + stdout
 
+    @property
+    def _output_segments(self) -> list['bytes | tuple[BinaryIO, int]']:
+        stderr, stdout = _stderr.get(None), _stdout.get(None)
+        if stderr is None or stdout is None:
+            return []
+        segments = stderr.segments()
+        if stderr.getvalue()[-1:] not in ('', '\n'):
+            segments.append(b'\n')
+        return segments + stdout.segments()
+
+    @property
+    def _output_written(self) -> int:
+        return _stderr.get().written + _stdout.get().written
+
+    @property
+    def _output_spilled(self) -> bool:
+        return _stderr.get().spilled or _stdout.get().spilled
+
     @property
     def is_manual_output(self):
         return _is_manual_output.get()
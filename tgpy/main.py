@@ -14,7 +14,7 @@ from yaml import YAMLError
 from tgpy import __version__ as tgpy_version
 from tgpy import app
 from tgpy._handlers import add_handlers
-from tgpy.api import DATA_DIR, MODULES_DIR, WORKDIR, config
+from tgpy.api import DATA_DIR, MODULES_DIR, WORKDIR, config, watchdog
 from tgpy.modules import run_modules, serialize_module
 from tgpy.utils import SESSION_FILENAME, create_config_dirs
 
@@ -202,6 +202,7 @@ async def _async_main():
     logger.info('Starting TGPy...')
     app.client = create_client()
     add_handlers(app.client)
+    watchdog.start()
     await start_client()
     logger.info('TGPy is running!')
     await run_modules()
@@ -213,6 +214,7 @@ async def _async_main():
         logger.info('Received shutdown signal, cleaning up...')
 
     # Cleanup
+    watchdog.stop()
     logger.info('Stopping Telegram client...')
     await app.client.stop()
     logger.info('TGPy shutdown complete')
@@ -0,0 +1,56 @@
+"""
+name: loop_checkpoints
+origin: tgpy://builtin_module/loop_checkpoints
+priority: 200
+"""
+
+import ast
+
+import tgpy.api
+from tgpy._core.checkpoints import CHECKPOINT_NAME, install
+from tgpy.api.transformers import FusedTransformer
+
+LOOPS = (ast.For, ast.AsyncFor, ast.While)
+# statements with their own scope, where `await` can't be used or which are
+# processed separately
+SCOPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+
+def _checkpoint(loop: ast.AST) -> ast.stmt:
+    # if __tgpy_checkpoint__.due:
+    #     await __tgpy_checkpoint__
+    node = ast.If(
+        test=ast.Attribute(ast.Name(CHECKPOINT_NAME, ast.Load()), 'due', ast.Load()),
+        body=[ast.Expr(ast.Await(ast.Name(CHECKPOINT_NAME, ast.Load())))],
+        orelse=[],
+    )
+    return ast.fix_missing_locations(ast.copy_location(node, loop))
+
+
+def add_checkpoints(body: list[ast.stmt]):
+    """Add checkpoints to the beginning of the loops of the given async scope"""
+    for stmt in body:
+        if isinstance(stmt, SCOPES):
+            continue
+        if isinstance(stmt, LOOPS):
+            stmt.body.insert(0, _checkpoint(stmt))
+        for field in ('body', 'orelse', 'finalbody', 'handlers', 'cases'):
+            if block := getattr(stmt, field, None):
+                add_checkpoints(block)
+
+
+class CheckpointTransformer(FusedTransformer):
+    # code is run inside an async function
+    def visit_Module(self, node: ast.Module):
+        add_checkpoints(node.body)
+        return node
+
+    def visit_AsyncFunctionDef(self, node: ast.AsyncFunctionDef):
+        add_checkpoints(node.body)
+        return node
+
+
+install()
+tgpy.api.ast_transformers.add('loop_checkpoints', CheckpointTransformer)
+
+__all__ = []
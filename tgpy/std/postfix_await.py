@@ -9,11 +9,14 @@ import tokenize
 
 import tgpy.api
 from tgpy.api import tokenize_string, untokenize_to_string
+from tgpy.api.transformers import FusedTransformer
 
 AWAIT_REPLACEMENT_ATTRIBUTE = '__tgpy_await__'
 
 
 def code_trans(code: str) -> str:
+    if 'await' not in code:
+        return code
     tokens = tokenize_string(code)
     if not tokens:
         return code
@@ -31,9 +34,8 @@ def code_trans(code: str) -> str:
     return untokenize_to_string(tokens)
 
 
-class AwaitTransformer(ast.NodeTransformer):
+class AwaitTransformer(FusedTransformer):
     def visit_Attribute(self, node: ast.Attribute):
-        node = self.generic_visit(node)
         if node.attr == AWAIT_REPLACEMENT_ATTRIBUTE:
             return ast.Await(value=node.value)
         else:
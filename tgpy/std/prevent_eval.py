@@ -8,11 +8,16 @@ import re
 
 # from pyrogram import Client as TelegramClient
 from pyrogram.enums import MessageServiceType
+from pyrogram.errors import RPCError
 from pyrogram.types import Message
 
 import tgpy.api
 from tgpy import reactions_fix
+from tgpy._core.edit_scheduler import edit_scheduler
 from tgpy._core.eval_message import running_messages
+from tgpy._core.message_design import Utf16Index, utf16_len
+from tgpy._core.recent_messages import recent_messages
+from tgpy._handlers.dispatcher import dispatcher
 from tgpy.api.utils import outgoing_messages_filter
 
 # client: TelegramClient
@@ -22,6 +27,7 @@ MODULE_NAME = 'prevent_eval'
 IGNORED_MESSAGES_KEY = f'{MODULE_NAME}.ignored_messages'
 CANCEL_RGX = re.compile(r'(?i)^(cancel|сфтсуд)$')
 INTERRUPT_RGX = re.compile(r'(?i)^(stop|ыещз)$')
+COMMENT_PREFIX = '//'
 
 
 async def cancel_message(message: Message, permanent: bool = True) -> bool:
@@ -31,7 +37,10 @@ async def cancel_message(message: Message, permanent: bool = True) -> bool:
         task.cancel()
     if not parsed.is_tgpy_message:
         return False
+    # the edit must not be overwritten by an edit of the cancelled evaluation
+    await edit_scheduler.discard(message)
     message = await message.edit_text(parsed.code)
+    recent_messages.discard(message)
 
     if permanent:
         ignored_messages = tgpy.api.config.get(IGNORED_MESSAGES_KEY, [])
@@ -80,6 +89,24 @@ async def handle_cancel(message: Message, permanent: bool = True):
         thread_id = target.id
         target = None
 
+    if not target:
+        # running code is stopped without a request. Other messages are looked
+        # up in the history: the latest known one may be far older than the 10
+        # messages before the command
+        target = recent_messages.latest(message.chat.id, thread_id, before=message.id)
+        if target is not None and (target.chat.id, target.id) not in running_messages:
+            target = None
+        if target is not None:
+            try:
+                if await cancel_message(target, permanent):
+                    await message.delete()
+                    return
+            except RPCError:
+                # e.g. the message was deleted
+                pass
+            recent_messages.discard(target)
+            target = None
+
     if not target:
         if thread_id:
             messages = message._client.get_discussion_replies(
@@ -109,14 +136,19 @@ async def handle_comment(message: Message):
     ignored_messages.append([message.chat.id, message.id])
     tgpy.api.config.save()
 
-    entities = message.entities or []
-    for ent in entities:
-        if ent.offset < 2:
-            ent.length -= 2 - ent.offset
-            ent.offset = 0
-        else:
-            ent.offset -= 2
-    await message.edit_text(message.text[2:], entities=entities)
+    # entity offsets are in UTF-16 code units
+    prefix_len = utf16_len(COMMENT_PREFIX)
+    entities = []
+    for ent in message.entities or []:
+        end = ent.offset + ent.length
+        if end <= prefix_len:
+            continue
+        ent.offset = max(ent.offset - prefix_len, 0)
+        ent.length = end - prefix_len - ent.offset
+        entities.append(ent)
+    text = Utf16Index(message.text).slice(prefix_len)
+    await edit_scheduler.discard(message)
+    await message.edit_text(text, entities=entities)
 
 
 async def exec_hook(message: Message, is_edit: bool):
@@ -125,7 +157,8 @@ async def exec_hook(message: Message, is_edit: bool):
         return False
 
     is_comment = (
-        message.text.startswith('//') and message.text[2:].strip()
+        message.text.startswith(COMMENT_PREFIX)
+        and message.text[len(COMMENT_PREFIX) :].strip()
         if message.text
         else False
     )
@@ -146,6 +179,17 @@ async def exec_hook(message: Message, is_edit: bool):
     return False
 
 
+def is_cancel_command(message: Message) -> bool:
+    return bool(
+        message.text
+        and (
+            CANCEL_RGX.fullmatch(message.text) or INTERRUPT_RGX.fullmatch(message.text)
+        )
+    )
+
+
 tgpy.api.exec_hooks.add(MODULE_NAME, exec_hook)
+# cancel commands don't wait for the evaluations they may cancel
+dispatcher.urgent_filters[MODULE_NAME] = is_cancel_command
 
 __all__ = []
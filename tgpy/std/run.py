@@ -4,19 +4,208 @@ origin: tgpy://builtin_module/run
 priority: 550
 """
 
+import asyncio
+import contextvars
+import itertools
+import time
 from pathlib import Path
+from textwrap import dedent
+from typing import Any
 
+from pyrogram.errors import MessageIdInvalid
 from pyrogram.types import Message
 
 from tgpy import Context
+from tgpy._core import message_design
+from tgpy._core.eval_message import running_messages
+from tgpy._core.result_format import format_result
 from tgpy._core.utils import convert_result, format_traceback
 from tgpy.api import constants, tgpy_eval
 from tgpy.api.parse_tgpy_message import parse_tgpy_message
+from tgpy.context import ResourceLimitExceeded
 
 ctx: Context
 
+# how many finished jobs are kept
+MAX_FINISHED_JOBS = 50
 
-async def run() -> str | None:
+
+class Job:
+    """Code from a message running in the background"""
+
+    def __init__(self, job_id: int, code: str, message: Message | None):
+        self.id = job_id
+        self.code = code
+        # the message which shows the progress
+        self.message = message
+        self.started_at = time.monotonic()
+        self.finished_at: float | None = None
+        # set by `cancel`, as opposed to `cancel` in reply, which restores the code
+        self._cancel_requested = False
+        # the job has its own output, which is read from its context
+        self._context = contextvars.copy_context()
+        self.task = asyncio.create_task(self._run(), context=self._context)
+        # the error is shown in the message, no need to log it
+        self.task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    async def _run(self) -> Any:
+        ctx.is_manual_output = False
+        key = None
+        if self.message:
+            key = (self.message.chat.id, self.message.id)
+            # the job can be stopped with `cancel` like any running message
+            running_messages[key] = asyncio.current_task()
+        try:
+            eval_result = await tgpy_eval(self.code, message=self.message)
+        except asyncio.CancelledError:
+            if self._cancel_requested:
+                # noinspection PyProtectedMember
+                await self._show('Cancelled', output=ctx._output)
+            raise
+        except ResourceLimitExceeded as e:
+            _, constants['exc'] = format_traceback()
+            # noinspection PyProtectedMember
+            await self._show(str(e), output=ctx._output)
+            raise
+        except Exception:
+            exc, constants['exc'] = format_traceback()
+            await self._show(None, traceback=exc)
+            raise
+        else:
+            if not ctx.is_manual_output:
+                await self._show(eval_result.result, output=eval_result.output)
+            return eval_result.result
+        finally:
+            self.finished_at = time.monotonic()
+            if key is not None:
+                running_messages.pop(key, None)
+
+    async def _show(self, result: Any, traceback: str = '', output: str = ''):
+        if self.message is None:
+            return
+        try:
+            await message_design.edit_message(
+                self.message,
+                self.code,
+                format_result(result, message_design.MESSAGE_LIMIT)
+                if result
+                else result,
+                traceback=traceback,
+                output=output,
+            )
+        except MessageIdInvalid:
+            # the message was deleted
+            pass
+
+    @property
+    def status(self) -> str:
+        if not self.task.done():
+            return 'running'
+        if self.task.cancelled():
+            return 'cancelled'
+        if self.task.exception() is not None:
+            return 'failed'
+        return 'done'
+
+    @property
+    def runtime(self) -> float:
+        """Seconds the job has been running for"""
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def output(self) -> str:
+        """The last part of the output"""
+        # noinspection PyProtectedMember
+        return self._context.run(lambda: ctx._output)
+
+    @property
+    def output_size(self) -> int:
+        """Number of characters written to stdout and stderr"""
+        # noinspection PyProtectedMember
+        return self._context.run(lambda: ctx._output_written)
+
+    def tail(self, lines: int = 10) -> str:
+        """The last lines of the output"""
+        return '\n'.join(self.output.splitlines()[-lines:])
+
+    def cancel(self) -> bool:
+        if self.task.done():
+            return False
+        self._cancel_requested = True
+        return self.task.cancel()
+
+    async def wait(self) -> Any:
+        """Wait for the job to finish and return its result"""
+        await asyncio.wait([self.task])
+        if self.task.cancelled():
+            raise RuntimeError(f'Job {self.id} was cancelled')
+        return self.task.result()
+
+    def __await__(self):
+        return self.wait().__await__()
+
+    def __str__(self):
+        first_line = self.code.strip().partition('\n')[0]
+        return (
+            f'#{self.id} {self.status}, {self.runtime:.1f} s,'
+            f' output {self.output_size} chars: {first_line}'
+        )
+
+
+class JobsObject:
+    def __init__(self):
+        self._jobs: dict[int, Job] = {}
+        self._ids = itertools.count(1)
+
+    def start(self, code: str, message: Message | None) -> Job:
+        job = Job(next(self._ids), code, message)
+        self._jobs[job.id] = job
+        finished = [x for x in self._jobs.values() if x.task.done()]
+        for old in finished[: max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self._jobs[old.id]
+        return job
+
+    def list(self) -> list[Job]:
+        return list(self._jobs.values())
+
+    def tail(self, job_id: int, lines: int = 10) -> str:
+        return self[job_id].tail(lines)
+
+    def cancel(self, job_id: int) -> bool:
+        return self[job_id].cancel()
+
+    async def wait(self, job_id: int) -> Any:
+        return await self[job_id].wait()
+
+    def __str__(self):
+        if not self._jobs:
+            return 'You have no jobs. Start one with `run(background=True)`.'
+        return dedent(
+            """
+            Your jobs:
+            {}
+
+            See the output with `jobs.tail(id)`, stop a job with `jobs.cancel(id)`.
+            """
+        ).format('\n'.join(map(str, self._jobs.values())))
+
+    def __iter__(self):
+        return iter(self.list())
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __getitem__(self, job_id: int) -> Job:
+        return self._jobs[job_id]
+
+    def __contains__(self, job_id: int):
+        return job_id in self._jobs
+
+
+jobs = JobsObject()
+
+
+async def run(background: bool = False) -> str | int | None:
     original: Message = ctx.msg.reply_to_message
     if original is None:
         return 'Use this function in reply to a message'
@@ -31,6 +220,12 @@ async def run() -> str | None:
             return 'Failed to read file attachment'
     else:
         return 'No code found in reply message'
+
+    if background:
+        # the job shows its progress in a message of its own
+        message = await ctx.msg.reply_text('Starting a job…', quote=True)
+        return jobs.start(code, message).id
+
     # Execute the code in background and return the result
     try:
         eval_result = await tgpy_eval(code, message=None, filename=None)
@@ -39,17 +234,17 @@ async def run() -> str | None:
 
         # Format the result for return
         if result is not None and output:
-            return f"{result}\n\n{output}"
+            return f'{result}\n\n{output}'
         elif result is not None:
             return str(result)
         elif output:
             return output
         else:
-            return "Code executed successfully (no output)"
+            return 'Code executed successfully (no output)'
 
     except Exception:
         exc, constants['exc'] = format_traceback()
-        return f"Error executing code:\n{exc}"
+        return f'Error executing code:\n{exc}'
 
 
-__all__ = ['run']
\ No newline at end of file
+__all__ = ['run', 'jobs']
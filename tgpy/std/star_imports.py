@@ -7,6 +7,7 @@ priority: 300
 import ast
 
 import tgpy.api
+from tgpy.api.transformers import FusedTransformer
 
 
 def unwrap_star_import(module_name: str) -> list[str]:
@@ -19,9 +20,8 @@ def unwrap_star_import(module_name: str) -> list[str]:
     return names
 
 
-class StarImportsTransformer(ast.NodeTransformer):
+class StarImportsTransformer(FusedTransformer):
     def visit_ImportFrom(self, node: ast.ImportFrom):
-        node = self.generic_visit(node)
         if node.names[0].name == '*':
             try:
                 # this has a downside of delaying the start